@@ -0,0 +1,185 @@
+"""Benchmarks of the car detectors and the stages of the processing of a video.
+
+A synthetic traffic video is generated and each configuration of detector and number of jobs is measured in its own
+process, so that the peak memory of a configuration is not affected by the others. For each configuration, the
+results contain:
+
+- the frames per second of ``Processor.process_video`` and ``Processor.process_video_headless``,
+- the latency percentiles of each stage of the processing, recorded by a ``Profiler`` in one more run with the same
+  number of jobs: decoding, detection (in the worker processes if there are several jobs), tracking, drawing and
+  encoding,
+- the peak resident memory of the process and of its worker processes.
+
+The results are written as JSON, together with the commit and the versions used, and can be compared with the
+results of other commit.
+
+Example:
+    python -m benchmarks.run --detectors classic background --n-jobs 1 4 --output results.json
+    python -m benchmarks.run --compare results.json --output new_results.json
+"""
+from typing import Any, Dict, List, Optional, Sequence
+
+import argparse
+import dataclasses
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+from benchmarks.synthetic import TrafficConfig, generate_video
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DETECTORS = ("classic", "background", "yolo")
+
+
+def _create_car_detector(name: str):
+    if name == "classic":
+        from src.car_detectors import ClassicDetector
+        return ClassicDetector()
+    if name == "background":
+        from src.car_detectors import BackgroundSubtractionDetector
+        return BackgroundSubtractionDetector()
+    from src.car_detectors import YoloDetector
+    return YoloDetector()
+
+
+def _measure_stages(processor, n_jobs: int) -> Dict[str, Dict[str, float]]:
+    """Processes the video with a profiler and returns the statistics of each stage, with the durations in
+    milliseconds.
+
+    With a single job the video is written with ``process_video_to_file``, so every stage of a frame is recorded,
+    from its decoding to its encoding. With several jobs ``process_video`` is used, where the frames are decoded at
+    once and detected by the worker processes.
+    """
+    if n_jobs == 1:
+        processor.process_video_to_file(os.path.join(tempfile.mkdtemp(), "stages.avi"))
+    else:
+        processor.process_video(n_jobs=n_jobs)
+    return processor.profiler.summary()["stages"]
+
+
+def _peak_rss_mb() -> Dict[str, float]:
+    """Returns the peak resident memory of this process and of its largest finished child process, in MiB."""
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return {"self_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20,
+            "children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20}
+
+
+def run_configuration(video_path: str, detector: str, n_jobs: int, repeat: int = 1) -> Dict[str, Any]:
+    """Benchmarks a configuration in this process. The peak memory is only meaningful in a fresh process."""
+    from src import Processor
+    from src.profiling import Profiler
+
+    def processor(profiler: Optional[Profiler] = None):
+        return Processor(_create_car_detector(detector), video_path, action_zone=(0, 0, None, None), stream=True,
+                         profiler=profiler)
+
+    n_frames = len(processor().video)
+    timings = {"process_video": [], "process_video_headless": []}
+    car_counter = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        processor().process_video(n_jobs=n_jobs)
+        timings["process_video"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        result = processor().process_video_headless(n_jobs=n_jobs)
+        timings["process_video_headless"].append(time.perf_counter() - start)
+        car_counter = result.car_counter
+
+    return {
+        "detector": detector,
+        "n_jobs": n_jobs,
+        # The best run is the least disturbed by the rest of the machine
+        "fps": {name: n_frames / min(times) for name, times in timings.items()},
+        "stages": _measure_stages(processor(Profiler(keep_events=False)), n_jobs),
+        "car_counter": car_counter,
+        "peak_rss": _peak_rss_mb(),
+    }
+
+
+def _run_in_subprocess(video_path: str, detector: str, n_jobs: int, repeat: int) -> Dict[str, Any]:
+    command = [sys.executable, "-m", "benchmarks.run", "--single", video_path, detector, str(n_jobs),
+               "--repeat", str(repeat)]
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"detector": detector, "n_jobs": n_jobs, "error": completed.stderr.strip().splitlines()[-1:]}
+    return json.loads(completed.stdout)
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+
+
+def compare(old_results: Dict[str, Any], new_results: Dict[str, Any]) -> List[str]:
+    """Returns a line for each configuration in both results with the ratio of the new and the old frames per
+    second."""
+    old_configurations = {(result["detector"], result["n_jobs"]): result for result in old_results["results"]}
+    lines = []
+    for result in new_results["results"]:
+        old_result = old_configurations.get((result["detector"], result["n_jobs"]))
+        if old_result is None or "error" in result or "error" in old_result:
+            continue
+        ratios = ", ".join(f"{name} x{fps / old_result['fps'][name]:.2f}" for name, fps in result["fps"].items())
+        lines.append(f"{result['detector']} n_jobs={result['n_jobs']}: {ratios}")
+    return lines
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the car detectors on a synthetic traffic video.")
+    parser.add_argument("--single", nargs=3, metavar=("VIDEO", "DETECTOR", "N_JOBS"), help=argparse.SUPPRESS)
+    parser.add_argument("--detectors", nargs="+", choices=DETECTORS, default=["classic", "background"])
+    parser.add_argument("--n-jobs", nargs="+", type=int, default=[1])
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--frames", type=int, default=300, help="length of the video in frames")
+    parser.add_argument("--density", type=float, default=4, help="average number of cars in a frame")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each configuration, the best is kept")
+    parser.add_argument("--output", help="path of the JSON file with the results, printed if not set")
+    parser.add_argument("--compare", help="JSON file with previous results to compare with")
+    args = parser.parse_args(argv)
+
+    if args.single:
+        video_path, detector, n_jobs = args.single
+        print(json.dumps(run_configuration(video_path, detector, int(n_jobs), args.repeat)))
+        return
+
+    config = TrafficConfig(args.width, args.height, args.frames, args.density, seed=args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = os.path.join(directory, "traffic.avi")
+        n_cars = generate_video(video_path, config)
+        results = [_run_in_subprocess(video_path, detector, n_jobs, args.repeat)
+                   for detector in args.detectors for n_jobs in args.n_jobs]
+
+    output = {"metadata": _metadata(), "video": dict(dataclasses.asdict(config), n_cars=n_cars), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            print("\n".join(compare(json.load(file), output)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
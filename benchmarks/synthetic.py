@@ -0,0 +1,158 @@
+"""Generation of deterministic synthetic traffic videos: cars moving along the lanes of a road on a noisy
+background."""
+from typing import Iterator, List
+
+from dataclasses import dataclass
+import cv2
+import numpy as np
+
+from src.data_structures import Frame, VideoWriter
+
+
+@dataclass
+class TrafficConfig:
+    """The parameters of a synthetic traffic video. The same parameters always give the same video.
+
+    Args:
+        width: the width of the frames. Defaults to 640.
+        height: the height of the frames. Defaults to 480.
+        n_frames: the number of frames. Defaults to 300.
+        density: the average number of cars in a frame. Defaults to 4.
+        fps: the frames per second. Defaults to 25.
+        noise: the standard deviation of the noise added to each frame. Defaults to 6.
+        seed: the seed of the random generator. Defaults to 0.
+    """
+
+    width: int = 640
+    height: int = 480
+    n_frames: int = 300
+    density: float = 4
+    fps: int = 25
+    noise: float = 6
+    seed: int = 0
+
+
+@dataclass
+class _Car:
+    lane: int
+    x: float
+    width: int
+    height: int
+    color: tuple
+
+
+class TrafficGenerator:
+    """Generates the frames of a synthetic traffic video.
+
+    The road has horizontal lanes, with traffic going right in the even lanes and left in the odd ones. All the cars
+    of a lane have the speed of the lane, so they never overlap, and new cars enter at a rate that keeps the average
+    number of cars in a frame close to the density. The traffic is simulated for a while before the first frame, so
+    the road is not empty at the start.
+
+    The noise of each frame is taken from a small bank of noise images generated once, which is much cheaper than
+    generating new noise for every frame.
+
+    Args:
+        config: the parameters of the video
+    """
+
+    def __init__(self, config: TrafficConfig):
+        self.config = config
+        self.rng = np.random.default_rng(config.seed)
+        self.scale = config.width / 640
+        self.lane_height = max(30, round(60 * self.scale))
+        self.n_lanes = max(1, min(6, (config.height - 2 * self.lane_height) // self.lane_height))
+        self.road_top = (config.height - self.n_lanes * self.lane_height) // 2
+        self.lane_speeds = self.rng.uniform(2, 6, self.n_lanes) * self.scale
+        self.background = self._background()
+        self.cars: List[_Car] = []
+        self.n_cars = 0
+
+        mean_car_width = 55 * self.scale
+        mean_transit_frames = np.mean((config.width + mean_car_width) / self.lane_speeds)
+        self.spawn_rate = config.density / mean_transit_frames
+        self.noise_bank = [self.rng.normal(0, config.noise, self.background.shape).astype(np.int16)
+                           for _ in range(8 if config.noise else 0)]
+        for _ in range(round(mean_transit_frames)):
+            self._step()
+        self.n_cars = len(self.cars)
+
+    def _background(self) -> np.ndarray:
+        """Returns a textured background with a gray road and lane markings."""
+        config = self.config
+        texture = self.rng.integers(0, 256, (config.height // 8 + 1, config.width // 8 + 1, 3), dtype=np.uint8)
+        background = cv2.resize(texture, (config.width, config.height), interpolation=cv2.INTER_CUBIC)
+        background = cv2.addWeighted(background, 0.4, np.full_like(background, (60, 110, 70)), 0.6, 0)
+        road_bottom = self.road_top + self.n_lanes * self.lane_height
+        background[self.road_top:road_bottom] = 90
+        for lane in range(1, self.n_lanes):
+            y = self.road_top + lane * self.lane_height
+            for x in range(0, config.width, round(40 * self.scale)):
+                cv2.line(background, (x, y), (x + round(20 * self.scale), y), (220, 220, 220), 2)
+        return background
+
+    def _lane_is_free(self, lane: int) -> bool:
+        """Returns whether a car can enter the lane without overlapping the last car that entered it."""
+        gap = 20 * self.scale
+        for car in self.cars:
+            if car.lane != lane:
+                continue
+            if lane % 2 == 0 and car.x < gap:
+                return False
+            if lane % 2 == 1 and car.x + car.width > self.config.width - gap:
+                return False
+        return True
+
+    def _spawn_cars(self) -> None:
+        for _ in range(self.rng.poisson(self.spawn_rate)):
+            lane = int(self.rng.integers(self.n_lanes))
+            width = round(self.rng.uniform(40, 70) * self.scale)
+            height = min(self.lane_height - 6, round(width * self.rng.uniform(0.45, 0.6)))
+            color = tuple(int(c) for c in self.rng.integers(0, 256, 3))
+            if self._lane_is_free(lane):
+                x = -width if lane % 2 == 0 else self.config.width
+                self.cars.append(_Car(lane, x, width, height, color))
+                self.n_cars += 1
+
+    def _step(self) -> None:
+        """Moves the cars one frame forward, removing the ones that left the road and adding new ones."""
+        for car in self.cars:
+            car.x += self.lane_speeds[car.lane] * (1 if car.lane % 2 == 0 else -1)
+        self.cars = [car for car in self.cars if -car.width <= car.x <= self.config.width]
+        self._spawn_cars()
+
+    def _render(self) -> np.ndarray:
+        image = self.background.copy()
+        for car in self.cars:
+            y = self.road_top + car.lane * self.lane_height + (self.lane_height - car.height) // 2
+            x = round(car.x)
+            cv2.rectangle(image, (x, y), (x + car.width, y + car.height), car.color, -1)
+            cv2.rectangle(image, (x + car.width // 4, y + 3), (x + 3 * car.width // 4, y + car.height - 3),
+                          (40, 40, 40), -1)
+        if self.noise_bank:
+            noise = self.noise_bank[self.rng.integers(len(self.noise_bank))]
+            image = np.clip(image + noise, 0, 255).astype(np.uint8)
+        return image
+
+    def frames(self) -> Iterator[np.ndarray]:
+        """Yields the BGR images of the frames of the video."""
+        for _ in range(self.config.n_frames):
+            yield self._render()
+            self._step()
+
+
+def generate_video(path: str, config: TrafficConfig) -> int:
+    """Writes a synthetic traffic video.
+
+    Args:
+        path: the path of the video. Its extension determines the container.
+        config: the parameters of the video
+
+    Returns:
+        The number of cars on the road in the first frame or entering it later.
+    """
+    generator = TrafficGenerator(config)
+    with VideoWriter(path, config.fps, (config.width, config.height)) as writer:
+        for image in generator.frames():
+            writer.write(Frame(image))
+    return generator.n_cars
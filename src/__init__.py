@@ -1,2 +1,6 @@
 from .processor import Processor
-from .tracker import Tracker
+from .tracker import Tracker, AssignmentTracker
+from .frame_skipper import FrameSkipper
+from .detection_cache import DetectionCache
+from .profiling import Profiler
+from .sharding import ShardedProcessor
@@ -0,0 +1,357 @@
+"""Processing of many videos in parallel, on one or several machines.
+
+The videos are given as a directory or as a manifest file with a path per line. They are processed by a pool of
+processes, each of which loads its car detector once. The result of each video is written to the output directory
+as soon as it is finished, so an interrupted run skips the finished videos when it is run again: a JSON file with the
+counters and, unless the processed videos are saved instead, the cars tracked in each frame as a ``.npz`` file which
+can be read with ``ProcessingResult.load``.
+
+Several machines sharing a filesystem can process the same manifest at once: either with a static shard each
+(``--shard 0/4``, ``--shard 1/4``...), or with ``--work-queue``, where each video is claimed by the first worker to
+create its claim file in the output directory. The results of a video are named after its path relative to the
+source directory or to the directory of the manifest, so they do not depend on where each machine mounts it.
+
+Example:
+    python -m src.batch data/ --output-dir results/ --n-jobs 8 --work-queue
+"""
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from contextlib import contextmanager, nullcontext
+import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from src.car_detectors.car_detector import CarDetector
+from src.processor import Processor
+from src.tracker import Tracker
+
+
+VIDEO_EXTENSIONS = (".avi", ".mp4", ".mov", ".mkv", ".mpg", ".mpeg", ".m4v", ".wmv")
+
+# State of the workers of the pool, set by _init_worker
+_worker_car_detector: Optional[CarDetector] = None
+
+
+def collect_videos(source: str) -> List[str]:
+    """Returns the paths of the videos of a directory (searched recursively) or listed in a manifest file.
+
+    The manifest has a path per line. Empty lines and lines starting with # are ignored, and relative paths are
+    relative to the directory of the manifest.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(directory, file_name)
+                      for directory, _, file_names in os.walk(source)
+                      for file_name in file_names if file_name.lower().endswith(VIDEO_EXTENSIONS))
+
+    manifest_directory = os.path.dirname(source)
+    with open(source) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [os.path.join(manifest_directory, line) for line in lines if line and not line.startswith("#")]
+
+
+def source_directory(source: str) -> str:
+    """Returns the directory the videos of a source are relative to: the source itself if it is a directory, or the
+    directory of the manifest."""
+    return source if os.path.isdir(source) else os.path.dirname(source) or os.curdir
+
+
+def clip_id(path: str, source_dir: Optional[str] = None) -> str:
+    """Returns a name for the results of a video which is unique within a source.
+
+    Args:
+        path: the path of the video
+        source_dir: the directory the video is relative to, see ``source_directory``. The name only depends on the
+            path of the video relative to it, so it is the same however the directory is written, e.g. as an
+            absolute or a relative path or at another mount point. If None, or if the video is not in it, the path
+            is used as it is written. Defaults to None.
+
+    Examples:
+        >>> clip_id("/mnt/a/videos/day1/cam.avi", "/mnt/a/videos") == clip_id("day1/cam.avi", "day1/..")
+        True
+    """
+    key = os.path.normpath(path)
+    if source_dir is not None:
+        relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(source_dir))
+        if relative_path != os.pardir and not relative_path.startswith(os.pardir + os.sep):
+            key = relative_path
+    name = os.path.splitext(os.path.basename(path))[0]
+    return f"{name}-{hashlib.sha1(key.replace(os.sep, '/').encode()).hexdigest()[:10]}"
+
+
+def _write_json(path: str, content: Dict[str, Any]) -> None:
+    """Writes the file atomically, so a crash never leaves a partial result behind."""
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(content, file, indent=2)
+    os.replace(temporary_path, path)
+
+
+class BatchRunner:
+    """Processes many videos with a pool of processes.
+
+    Args:
+        car_detector_factory: a picklable callable which creates the car detector, e.g. a detector class or a
+            ``functools.partial`` of it. It is called once in each worker.
+        output_dir: the directory where the results of the videos are written
+        n_jobs: the number of processes. If not positive, the number of CPUs is used. Defaults to -1.
+        tracker_factory: a picklable callable which creates the tracker of each video. Defaults to ``Tracker``.
+        processor_kwargs: other arguments for the ``Processor`` of each video, e.g. the action zone. Defaults to
+            None.
+        save_videos: whether to write the processed videos to the output directory instead of the cars tracked in
+            each frame, which is much slower. Defaults to False.
+        shard: a (index, count) tuple to process only the videos of one of count disjoint shards. Defaults to None.
+        work_queue: whether to claim each video before processing it, so that several runs can share the manifest.
+            Defaults to False.
+        claim_timeout: the time, in seconds, after which the claim of an unfinished video is considered abandoned
+            and the video can be claimed again. The process working on a video refreshes its claim four times per
+            timeout, so only the claims of dead processes are abandoned. Only used if work_queue is True. Defaults
+            to 6 hours.
+        source_dir: the directory the videos are relative to, from which the names of their results are derived,
+            see ``clip_id``. Defaults to None.
+    """
+
+    def __init__(self,
+                 car_detector_factory: Callable[[], CarDetector],
+                 output_dir: str,
+                 n_jobs: int = -1,
+                 tracker_factory: Callable[[], Tracker] = Tracker,
+                 processor_kwargs: Optional[Dict[str, Any]] = None,
+                 save_videos: bool = False,
+                 shard: Optional[Tuple[int, int]] = None,
+                 work_queue: bool = False,
+                 claim_timeout: float = 6 * 3600,
+                 source_dir: Optional[str] = None):
+        self.car_detector_factory = car_detector_factory
+        self.output_dir = output_dir
+        self.n_jobs = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+        self.tracker_factory = tracker_factory
+        self.processor_kwargs = processor_kwargs or {}
+        self.save_videos = save_videos
+        self.shard = shard
+        self.work_queue = work_queue
+        self.claim_timeout = claim_timeout
+        self.source_dir = source_dir
+
+    def _clip_id(self, path: str) -> str:
+        return clip_id(path, self.source_dir)
+
+    def _result_path(self, path: str) -> str:
+        return os.path.join(self.output_dir, f"{self._clip_id(path)}.json")
+
+    def _claim(self, path: str) -> Optional[str]:
+        """Tries to claim the video for this process. Abandoned claims are taken over.
+
+        The claims of a video are numbered files in its own directory, and the last one is the current claim. An
+        abandoned claim is taken over by creating the next one, which only one process can do, so two processes
+        which find the same abandoned claim never both take it over, and the claim of each process is never touched
+        by the others.
+
+        Returns:
+            The path of the claim of this process, or None if the video is claimed by other process or has already
+            been processed.
+        """
+        claim_directory = os.path.join(self.output_dir, "claims", self._clip_id(path))
+        os.makedirs(claim_directory, exist_ok=True)
+        generation = max((int(name) for name in os.listdir(claim_directory) if name.isdigit()), default=-1)
+        if generation >= 0:
+            try:
+                if time.time() - os.path.getmtime(os.path.join(claim_directory, str(generation))) <= self.claim_timeout:
+                    return None
+            except FileNotFoundError:
+                # The claim was released by a process which failed
+                pass
+        claim_path = os.path.join(claim_directory, str(generation + 1))
+        try:
+            descriptor = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(descriptor, "w") as claim:
+            claim.write(f"{socket.gethostname()}:{os.getpid()}\n")
+        # The video may have been finished by the process whose claim was taken over, or by another process since
+        # the pending videos were listed
+        return None if os.path.exists(self._result_path(path)) else claim_path
+
+    @contextmanager
+    def _heartbeat(self, claim_path: str) -> Iterator[None]:
+        """Refreshes the claim in a background thread while the code it wraps runs, so that the claim of a video
+        which takes longer than the claim timeout is not taken over."""
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.wait(self.claim_timeout / 4):
+                try:
+                    os.utime(claim_path)
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=refresh, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def pending_videos(self, videos: Sequence[str]) -> List[str]:
+        """Returns the videos of this shard which have not been processed yet."""
+        if self.shard is not None:
+            index, count = self.shard
+            videos = [path for path in videos if int(self._clip_id(path).rsplit("-", 1)[1], 16) % count == index]
+        return [path for path in videos if not os.path.exists(self._result_path(path))]
+
+    def process_clip(self, path: str) -> Optional[Dict[str, Any]]:
+        """Processes a video with the car detector of this process and writes its result.
+
+        Returns:
+            The result, or None if the video was claimed by other process or has already been processed.
+        """
+        claim_path = self._claim(path) if self.work_queue else None
+        if self.work_queue and claim_path is None:
+            return None
+
+        heartbeat: ContextManager = self._heartbeat(claim_path) if claim_path is not None else nullcontext()
+        start = time.perf_counter()
+        try:
+            with heartbeat:
+                car_detector = (_worker_car_detector if _worker_car_detector is not None
+                                else self.car_detector_factory())
+                car_detector.reset()
+                processor = Processor(car_detector, path, tracker=self.tracker_factory(), stream=True,
+                                      **self.processor_kwargs)
+                if self.save_videos:
+                    processor.process_video_to_file(os.path.join(self.output_dir, f"{self._clip_id(path)}.avi"))
+                else:
+                    processor.process_video_headless().save(os.path.join(self.output_dir, f"{self._clip_id(path)}.npz"))
+        except Exception as exception:
+            # Only the claim of this process is released, even if it was taken over since
+            if claim_path is not None:
+                os.remove(claim_path)
+            return {"video": path, "error": repr(exception)}
+
+        result = {
+            "video": path,
+            "frames": len(processor.video),
+            "car_counter": processor.tracker.car_counter,
+            "zone_counts": processor.zone_counter.counts if processor.zone_counter is not None else {},
+            "elapsed_seconds": time.perf_counter() - start,
+            "host": socket.gethostname(),
+        }
+        _write_json(self._result_path(path), result)
+        return result
+
+    def iter_run(self, videos: Sequence[str]) -> Iterator[Dict[str, Any]]:
+        """Processes the pending videos, yielding the result of each video as it finishes, in any order.
+
+        The results of failed videos have an "error" key and are not written, so they are retried in the next run.
+        """
+        os.makedirs(os.path.join(self.output_dir, "claims"), exist_ok=True)
+        pending_videos = self.pending_videos(videos)
+        if self.n_jobs == 1:
+            results = map(self.process_clip, pending_videos)
+            yield from (result for result in results if result is not None)
+            return
+
+        with multiprocessing.Pool(self.n_jobs, initializer=_init_worker, initargs=(self.car_detector_factory,)) as pool:
+            for result in pool.imap_unordered(self.process_clip, pending_videos):
+                if result is not None:
+                    yield result
+
+    def run(self, videos: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        """Processes the pending videos and returns the results of all the videos of this shard, by path, including
+        the ones processed in previous runs."""
+        failed = {result["video"]: result for result in self.iter_run(videos) if "error" in result}
+        results = {}
+        for path in videos:
+            result_path = self._result_path(path)
+            if os.path.exists(result_path):
+                with open(result_path) as file:
+                    results[path] = json.load(file)
+            elif path in failed:
+                results[path] = failed[path]
+        return results
+
+
+def _init_worker(car_detector_factory: Callable[[], CarDetector]):
+    global _worker_car_detector
+    _worker_car_detector = car_detector_factory()
+
+
+def _car_detector_factory(args: argparse.Namespace) -> Callable[[], CarDetector]:
+    # Only the detector used is imported, so torch is not imported unless YOLO is used
+    if args.detector == "classic":
+        from src.car_detectors import ClassicDetector
+        return functools.partial(ClassicDetector, min_area=args.min_area)
+    if args.detector == "background":
+        from src.car_detectors import BackgroundSubtractionDetector
+        return functools.partial(BackgroundSubtractionDetector, min_area=args.min_area)
+    from src.car_detectors import YoloDetector
+    factory = functools.partial(YoloDetector, yolo_model=args.yolo_model, hub_repo=args.yolo_repo,
+                                backend=args.yolo_backend, imgsz=args.imgsz)
+    return functools.partial(_motion_gated, factory) if args.motion_gated else factory
+
+
+def _motion_gated(car_detector_factory: Callable[[], CarDetector]) -> CarDetector:
+    from src.car_detectors import CascadeDetector
+    return CascadeDetector(car_detector_factory())
+
+
+def _parse_shard(shard: str) -> Tuple[int, int]:
+    index, count = (int(value) for value in shard.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard {shard}, it must be INDEX/COUNT with 0 <= INDEX < COUNT.")
+    return index, count
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Counts the cars of many videos in parallel.")
+    parser.add_argument("source", help="directory with the videos or manifest file with a video path per line")
+    parser.add_argument("--output-dir", required=True, help="directory where the results are written")
+    parser.add_argument("--detector", choices=("classic", "background", "yolo"), default="classic")
+    parser.add_argument("--min-area", type=int, default=800, help="minimum area of a car (classic and background)")
+    parser.add_argument("--yolo-model", default="yolov5s", help="YOLOv5 model name or weights file (yolo)")
+    parser.add_argument("--yolo-repo", default="ultralytics/yolov5",
+                        help="YOLOv5 GitHub repository or local clone, for offline use (yolo)")
+    parser.add_argument("--yolo-backend", choices=("torch", "torchscript", "onnx", "onnxruntime"),
+                        help="inference backend, by default the one the model was exported for (yolo)")
+    parser.add_argument("--imgsz", type=int, help="size of the images given to the model (yolo)")
+    parser.add_argument("--motion-gated", action="store_true",
+                        help="run the model only on the regions of the frames with motion (yolo)")
+    parser.add_argument("--tol", type=float, default=10, help="tolerance of the tracker")
+    parser.add_argument("--min-trace-length", type=int, default=10, help="minimum length of a trace of a car")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="number of processes, all the CPUs by default")
+    parser.add_argument("--save-videos", action="store_true", help="write the processed videos")
+    parser.add_argument("--shard", type=_parse_shard, help="process only the shard INDEX/COUNT of the videos")
+    parser.add_argument("--work-queue", action="store_true",
+                        help="claim the videos before processing them, to share the manifest between machines")
+    parser.add_argument("--claim-timeout", type=float, default=6 * 3600,
+                        help="seconds after which the claim of an unfinished video is abandoned")
+    args = parser.parse_args(argv)
+
+    runner = BatchRunner(_car_detector_factory(args),
+                         args.output_dir,
+                         n_jobs=args.n_jobs,
+                         tracker_factory=functools.partial(Tracker, args.tol, args.min_trace_length),
+                         save_videos=args.save_videos,
+                         shard=args.shard,
+                         work_queue=args.work_queue,
+                         claim_timeout=args.claim_timeout,
+                         source_dir=source_directory(args.source))
+    n_processed = n_failed = 0
+    for result in runner.iter_run(collect_videos(args.source)):
+        if "error" in result:
+            n_failed += 1
+            print(f"FAILED {result['video']}: {result['error']}")
+        else:
+            n_processed += 1
+            print(f"{result['video']}: {result['car_counter']} cars ({result['elapsed_seconds']:.1f} s)")
+    print(f"{n_processed} videos processed, {n_failed} failed.")
+
+
+if __name__ == "__main__":
+    main()
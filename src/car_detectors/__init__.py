@@ -1,3 +1,13 @@
 from .car_detector import CarDetector
 from .classic_detector import ClassicDetector
-from .yolo_detector import YoloDetector
+from .background_detector import BackgroundSubtractionDetector
+from .cascade_detector import CascadeDetector
+
+
+def __getattr__(name):
+    # YoloDetector is imported on first use, so that torch is only imported when it is needed
+    if name == "YoloDetector":
+        from .yolo_detector import YoloDetector
+
+        return YoloDetector
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
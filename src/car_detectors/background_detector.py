@@ -0,0 +1,116 @@
+from typing import Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from .classic_detector import ClassicDetector
+from src.data_structures import Detections, Frame, Rectangle
+
+
+class BackgroundSubtractionDetector(ClassicDetector):
+    """Car detector based on a model of the background of the video which is updated with every frame.
+
+    Unlike the difference between two consecutive frames, the difference with the background also finds the cars
+    that move slowly or are stopped, and finds long vehicles as a single blob, so much less morphology is needed.
+    The preprocessing (action zone, scale) is the same as in ``ClassicDetector``.
+
+    Since the background depends on every previous frame, the detector cannot be split between processes.
+
+    Args:
+        method: the background model. One of 'running_average' (an exponential moving average of the frames),
+            'mog2' or 'knn' (OpenCV's mixture of gaussians and k-nearest neighbours subtractors). Defaults to
+            'running_average'.
+        learning_rate: the weight of each new frame in the background, between 0 and 1. Defaults to 0.01.
+        threshold: the minimum difference with the background of a pixel of a car. Only used by 'running_average'.
+            Defaults to 30.
+        iterations: the number of times the foreground is dilated to join the blobs of a car. Defaults to 1.
+        warmup_frames: the number of frames used to learn the background before detecting cars. Defaults to 25.
+        min_area: minimum area of a rectangle to be considered a car, in pixels of the full frame. Defaults to 800.
+        action_zone: the region of the frame where to detect cars, as in ``ClassicDetector``. If None, the whole
+            frame is used. Defaults to None.
+        scale: the factor by which the action zone is resized before being processed. Defaults to 1.0.
+
+    Raises:
+        ValueError: if the method is not known or the scale is not positive
+    """
+
+    METHODS = ("running_average", "mog2", "knn")
+
+    context_frames = 0
+    supports_multiprocessing = False
+    MEDIAN_SIZE = 5
+
+    def __init__(self,
+                 method: str = "running_average",
+                 learning_rate: float = 0.01,
+                 threshold: int = 30,
+                 iterations: int = 1,
+                 warmup_frames: int = 25,
+                 min_area: int = 800,
+                 action_zone: Optional[Union[Rectangle, Tuple[int, int, Optional[int], Optional[int]]]] = None,
+                 scale: float = 1.0):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown method {method}. Must be one of {self.METHODS}.")
+        super().__init__(min_area, action_zone, scale)
+        self.method = method
+        self.learning_rate = learning_rate
+        self.threshold = threshold
+        self.iterations = iterations
+        self.warmup_frames = warmup_frames
+        self.background: Optional[np.ndarray] = None
+        self._subtractor = None
+        self._n_frames = 0
+
+    def _reach(self) -> int:
+        return self.iterations * (self._kernel.shape[0] // 2) + self.MEDIAN_SIZE // 2
+
+    def reset(self) -> None:
+        """Forgets the background learned so far."""
+        super().reset()
+        self.background = None
+        self._subtractor = None
+        self._n_frames = 0
+
+    def detect_frame(self, frame: Frame) -> Detections:
+        """Detects cars in a frame and updates the background with it.
+
+        Args:
+            frame: the frame to detect cars in.
+
+        Returns:
+            The detected cars. No cars are detected while the background is being learned.
+        """
+        with self._stage("preprocess"):
+            gray = self._preprocess(frame.image, "gray_a")
+        with self._stage("foreground"):
+            foreground = self._foreground(gray)
+        self._n_frames += 1
+        if self._n_frames <= self.warmup_frames:
+            return Detections.empty()
+        with self._stage("find_cars"):
+            return self._find_cars(foreground, self.iterations, self.MEDIAN_SIZE)
+
+    def _foreground(self, gray: np.ndarray) -> np.ndarray:
+        """Returns the binary mask of the pixels which are not background and updates the background."""
+        foreground = self._buffer("diff", gray.shape)
+        if self.method == "running_average":
+            if self.background is None:
+                self.background = gray.astype(np.float32)
+            background = cv2.convertScaleAbs(self.background, dst=self._buffer("background", gray.shape))
+            cv2.absdiff(gray, background, dst=foreground)
+            cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+        else:
+            if self._subtractor is None:
+                self._subtractor = (cv2.createBackgroundSubtractorMOG2(detectShadows=False) if self.method == "mog2"
+                                    else cv2.createBackgroundSubtractorKNN(detectShadows=False))
+            self._subtractor.apply(gray, fgmask=foreground, learningRate=self.learning_rate)
+        threshold = self.threshold if self.method == "running_average" else 127
+        cv2.threshold(foreground, threshold, 255, cv2.THRESH_BINARY, dst=foreground)
+        return foreground
+
+    def __getstate__(self):
+        # OpenCV's background subtractors cannot be pickled, so the background is learned again
+        state = super().__getstate__()
+        if state["_subtractor"] is not None:
+            state.update(_subtractor=None, _n_frames=0)
+        return state
@@ -1,29 +1,132 @@
-from typing import List
+from typing import Any, ContextManager, Dict, List, Optional, Sequence, Iterable, Iterator, Tuple
 
 import abc
+import inspect
 
-from src.data_structures import Rectangle, Video, Frame
+from src.data_structures import Detections, Video, Frame
+from src.profiling import Profiler
 
 
 class CarDetector(abc.ABC):
-    """Base class for all car detectors"""
+    """Base class for all car detectors
 
-    def detect(self, video: Video) -> List[List[Rectangle]]:
+    Attributes:
+        context_frames: number of preceding frames the detector needs to have seen to detect cars in a frame. It is 0
+            for detectors that look at each frame independently. It is used to split a video into chunks that can be
+            processed in parallel while producing the same results as a sequential run.
+        batch_size: number of frames processed together by ``detect_stream``.
+        supports_multiprocessing: whether the detector should be copied to worker processes to detect cars in
+            parallel. Detectors holding a large model which already uses several threads set it to False, so that a
+            single copy of the model is used in the main process, and so do detectors whose state depends on every
+            previous frame.
+        stateful: whether the detections of a frame depend on the frames seen before it.
+        input_size: the side of the square images every image is resized to by the detector, e.g. by a neural
+            network, so that detecting cars in an image costs the same whatever its size. It is None for detectors
+            which work at the size of the image.
+        execution_parameters: the arguments of the constructor which only change how the detector runs, e.g. its
+            batch size or number of threads, and not its detections. They are left out of ``config``.
+        profiler: where the detector records the duration of its stages. The ``Processor`` sets its own profiler.
+            Disabled by default.
+    """
+
+    context_frames: int = 0
+    batch_size: int = 1
+    supports_multiprocessing: bool = True
+    stateful: bool = False
+    input_size: Optional[int] = None
+    execution_parameters: Tuple[str, ...] = ()
+    profiler: Profiler = Profiler(enabled=False)
+
+    def detect(self, video: Video) -> List[Detections]:
         """Detects cars in a video.
 
         Args:
             video: the video to detect cars in.
 
         Returns:
-            A list of lists of rectangles. Each list of rectangles represents a frame.
+            A list with the detections of each frame.
         """
 
-    def detect_frame(self, frame: Frame) -> List[Rectangle]:
+    def detect_frame(self, frame: Frame) -> Detections:
         """Detects cars in a frame.
 
         Args:
             frame: the frame to detect cars in.
 
         Returns:
-            A list of rectangles.
+            The detected cars.
+        """
+
+    def detect_batch(self, frames: Sequence[Frame]) -> List[Detections]:
+        """Detects cars in several consecutive frames at once.
+
+        Detectors that can process several frames more efficiently than one at a time should override it.
+
+        Args:
+            frames: the frames to detect cars in.
+
+        Returns:
+            A list with the detections of each frame.
+        """
+        return [self.detect_frame(frame) for frame in frames]
+
+    def detect_stream(self, frames: Iterable[Frame]) -> Iterator[Tuple[Frame, Detections]]:
+        """Detects cars in a stream of frames, processing them in batches of ``batch_size`` frames.
+
+        Only one batch of frames is kept in memory, so the stream can be arbitrarily long.
+
+        Args:
+            frames: the frames to detect cars in.
+
+        Yields:
+            Each frame together with its detections, in order.
+        """
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) >= self.batch_size:
+                with self._stage("detect"):
+                    detections_in_batch = self.detect_batch(batch)
+                yield from zip(batch, detections_in_batch)
+                batch = []
+        if batch:
+            with self._stage("detect"):
+                detections_in_batch = self.detect_batch(batch)
+            yield from zip(batch, detections_in_batch)
+
+    def detect_chunk(self, frames: Sequence[Frame], context: Sequence[Frame] = ()) -> List[Detections]:
+        """Detects cars in a contiguous chunk of frames of a video.
+
+        The state of the detector is reset and restored from the context frames, so the result does not depend on
+        the frames the detector has seen before. This makes it safe to process the chunks of a video in different
+        processes.
+
+        Args:
+            frames: the frames to detect cars in.
+            context: the frames immediately preceding the chunk in the video, at most ``context_frames`` of them.
+                They are only used to restore the state of the detector and no detections are returned for them.
+
+        Returns:
+            A list with the detections of each frame of the chunk.
+        """
+        self.reset()
+        for frame in context:
+            self.detect_frame(frame)
+        return [detections for _, detections in self.detect_stream(frames)]
+
+    def reset(self) -> None:
+        """Resets the state kept by the detector between frames. Stateless detectors do not need to override it."""
+
+    def _stage(self, name: str) -> ContextManager:
+        """Returns a context manager that records the duration of the code it wraps in the profiler."""
+        return self.profiler.stage(name)
+
+    def config(self) -> Dict[str, Any]:
+        """Returns the parameters of the detector, which together with its class determine its detections.
+
+        By default, the arguments of the constructor which are stored as attributes with the same name are returned,
+        except the ``execution_parameters``. Detectors whose detections depend on other values should override it.
         """
+        parameters = inspect.signature(type(self).__init__).parameters
+        return {name: getattr(self, name) for name in parameters
+                if name != "self" and name not in self.execution_parameters and hasattr(self, name)}
@@ -0,0 +1,222 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from src.car_detectors.car_detector import CarDetector
+from src.car_detectors.classic_detector import ClassicDetector
+from src.data_structures import Detections, Frame, Video
+
+
+class CascadeDetector(CarDetector):
+    """Car detector that runs an accurate but expensive detector, like ``YoloDetector``, only on the regions of the
+    frame where a cheap motion detector finds something moving.
+
+    The rectangles found by the motion detector are padded, merged while they overlap and cropped from the frame.
+    Detectors that resize every image to their ``input_size``, like neural networks, cost the same for a small crop
+    as for a whole frame, so the crops of all the frames of a batch are scaled as the whole frame would be and packed
+    together into as few canvases of the input size as possible. Detectors that work at the size of the image get
+    the crops as they are. Either way, the detector is called once per batch and its detections are moved back to
+    the coordinates of the frame. Frames without motion are not given to the detector at all.
+
+    On a mostly static camera, the detector then runs on a few canvases per batch instead of on every frame. Since
+    cars which do not move are not proposed, parked cars are not detected.
+
+    Args:
+        detector: the detector run on the crops. It must accept images of any size and be stateless.
+        motion_detector: the detector which proposes the regions. Defaults to a ``ClassicDetector`` working at half
+            resolution with a small minimum area, so that no moving car is missed.
+        padding: the number of pixels added around each region, so that the detector sees the whole car and some
+            context. Defaults to 32.
+        min_size: the minimum width and height of a crop, in pixels of the frame. Defaults to 96.
+        batch_size: the number of frames whose crops are given to the detector at once. If None, the batch size of
+            the detector is used. Defaults to None.
+
+    Raises:
+        ValueError: if the detector is stateful
+    """
+
+    supports_multiprocessing = False
+    stateful = True
+    execution_parameters = ("batch_size",)
+    # Gap between the crops packed in a canvas, filled with the gray used by YOLOv5 for padding
+    CANVAS_GAP = 16
+    CANVAS_COLOR = 114
+
+    def __init__(self,
+                 detector: CarDetector,
+                 motion_detector: Optional[CarDetector] = None,
+                 padding: int = 32,
+                 min_size: int = 96,
+                 batch_size: Optional[int] = None):
+        if detector.stateful:
+            raise ValueError("The detector of the crops must be stateless, since it sees crops of different frames.")
+        self.detector = detector
+        self.motion_detector = ClassicDetector(min_area=200, scale=0.5) if motion_detector is None else motion_detector
+        self.padding = padding
+        self.min_size = min_size
+        self.batch_size = detector.batch_size if batch_size is None else batch_size
+        self.context_frames = self.motion_detector.context_frames
+
+    def config(self) -> Dict[str, Any]:
+        return {
+            "detector": (type(self.detector).__name__, self.detector.config()),
+            "motion_detector": (type(self.motion_detector).__name__, self.motion_detector.config()),
+            "padding": self.padding,
+            "min_size": self.min_size,
+        }
+
+    def reset(self) -> None:
+        self.motion_detector.reset()
+        self.detector.reset()
+
+    def _regions(self, proposals: Detections, frame_size: Tuple[int, int]) -> List[Tuple[int, int, int, int]]:
+        """Returns the regions to crop around the proposals, as (x_min, y_min, x_max, y_max) tuples which do not
+        overlap."""
+        width, height = frame_size
+        regions = []
+        for x, y, w, h in proposals.boxes.tolist():
+            x_min, y_min, x_max, y_max = x - self.padding, y - self.padding, x + w + self.padding, y + h + self.padding
+            # Small regions are grown around their center up to the minimum size
+            grow_x, grow_y = max(0, self.min_size - (x_max - x_min)), max(0, self.min_size - (y_max - y_min))
+            x_min, x_max = x_min - grow_x // 2, x_max + grow_x - grow_x // 2
+            y_min, y_max = y_min - grow_y // 2, y_max + grow_y - grow_y // 2
+            regions.append([max(0, x_min), max(0, y_min), min(width, x_max), min(height, y_max)])
+
+        # Overlapping regions are merged until no two regions overlap, so a car is never detected twice
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    a, b = regions[i], regions[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del regions[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return [tuple(region) for region in regions if region[2] > region[0] and region[3] > region[1]]
+
+    def _pack(self, sizes: Sequence[Tuple[int, int]], canvas_size: int) -> List[Tuple[int, int, int]]:
+        """Places rectangles with the given (width, height), which fit in a canvas, in square canvases, in rows from
+        the tallest to the shortest.
+
+        Returns:
+            The index of the canvas and the (x, y) position of the top left corner of each rectangle.
+        """
+        placements: List[Tuple[int, int, int]] = [(0, 0, 0)] * len(sizes)
+        canvas, x, y, row_height = 0, 0, 0, 0
+        for index in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+            width, height = sizes[index]
+            if x + width > canvas_size:
+                x, y, row_height = 0, y + row_height + self.CANVAS_GAP, 0
+            if y + height > canvas_size:
+                canvas, x, y, row_height = canvas + 1, 0, 0, 0
+            placements[index] = (canvas, x, y)
+            x += width + self.CANVAS_GAP
+            row_height = max(row_height, height)
+        return placements
+
+    def _images(self,
+                frames: Sequence[Frame],
+                regions_in_frames: List[List[Tuple[int, int, int, int]]]) -> Tuple[List[Frame], List[Tuple]]:
+        """Builds the images given to the detector from the regions of the frames.
+
+        Returns:
+            The images, and for each region its frame, the region, and the index of its image, its (x, y) position
+            in the image and the scale applied to it.
+        """
+        crops = [(frame_index, region) for frame_index, regions in enumerate(regions_in_frames) for region in regions]
+        canvas_size = self.detector.input_size
+        if canvas_size is None:
+            images = [Frame(frames[frame_index].image[y_min:y_max, x_min:x_max])
+                      for frame_index, (x_min, y_min, x_max, y_max) in crops]
+            return images, [(frame_index, region, index, 0, 0, 1.0)
+                            for index, (frame_index, region) in enumerate(crops)]
+
+        # The crops are scaled as the whole frame would be scaled by the detector, so it sees the cars at the usual
+        # size, and they always fit in a canvas
+        placed_crops, sizes = [], []
+        for frame_index, (x_min, y_min, x_max, y_max) in crops:
+            frame = frames[frame_index]
+            scale = canvas_size / max(frame.width, frame.height)
+            size = (max(1, round((x_max - x_min) * scale)), max(1, round((y_max - y_min) * scale)))
+            placed_crops.append((frame_index, (x_min, y_min, x_max, y_max), scale))
+            sizes.append(size)
+        placements = self._pack(sizes, canvas_size)
+        canvases = [np.full((canvas_size, canvas_size, 3), self.CANVAS_COLOR, dtype=np.uint8)
+                    for _ in range(max(canvas for canvas, _, _ in placements) + 1)]
+        for (frame_index, (x_min, y_min, x_max, y_max), scale), (width, height), (canvas, x, y) in \
+                zip(placed_crops, sizes, placements):
+            crop = frames[frame_index].image[y_min:y_max, x_min:x_max]
+            canvases[canvas][y:y + height, x:x + width] = cv2.resize(
+                crop, (width, height), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        return ([Frame(canvas) for canvas in canvases],
+                [(frame_index, region, canvas, x, y, scale)
+                 for (frame_index, region, scale), (canvas, x, y) in zip(placed_crops, placements)])
+
+    @staticmethod
+    def _detections_in_region(detections: Detections, region: Tuple[int, int, int, int], x: int, y: int,
+                              scale: float) -> Detections:
+        """Returns the detections of an image whose center is in the region placed at (x, y) with the scale, in the
+        coordinates of the frame."""
+        x_min, y_min, x_max, y_max = region
+        width, height = (x_max - x_min) * scale, (y_max - y_min) * scale
+        centers = detections.boxes[:, :2] + detections.boxes[:, 2:] / 2
+        inside = ((centers[:, 0] >= x) & (centers[:, 0] < x + width) &
+                  (centers[:, 1] >= y) & (centers[:, 1] < y + height))
+        boxes = detections.boxes[inside].astype(np.float64)
+        corners = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+        corners = np.clip(corners, [x, y, x, y], [x + width, y + height, x + width, y + height])
+        corners = (corners - [x, y, x, y]) / scale + [x_min, y_min, x_min, y_min]
+        boxes = np.rint(np.concatenate([corners[:, :2], corners[:, 2:] - corners[:, :2]], axis=1))
+        return Detections(boxes, detections.class_ids[inside], detections.scores[inside], detections.labels)
+
+    def detect_batch(self, frames: Sequence[Frame]) -> List[Detections]:
+        """Detects cars in several consecutive frames, running the detector once on the crops of all of them.
+
+        Args:
+            frames: the frames to detect cars in.
+
+        Returns:
+            A list with the detections of each frame.
+        """
+        regions_in_frames = []
+        with self._stage("motion"):
+            for frame in frames:
+                regions_in_frames.append(self._regions(self.motion_detector.detect_frame(frame),
+                                                       (frame.width, frame.height)))
+        for regions in regions_in_frames:
+            self.profiler.count("regions", len(regions))
+        if not any(regions_in_frames):
+            return [Detections.empty() for _ in frames]
+
+        images, placed_regions = self._images(frames, regions_in_frames)
+        # Number of images the detector runs on per frame, which is 1 without the cascade
+        for _ in frames:
+            self.profiler.count("images_per_frame", len(images) / len(frames))
+        with self._stage("inference"):
+            detections_in_images = self.detector.detect_batch(images)
+
+        detections_in_regions = [[] for _ in frames]
+        for frame_index, region, image_index, x, y, scale in placed_regions:
+            detections_in_regions[frame_index].append(
+                self._detections_in_region(detections_in_images[image_index], region, x, y, scale))
+        return [Detections.concatenate(detections)[0] if detections else Detections.empty()
+                for detections in detections_in_regions]
+
+    def detect_frame(self, frame: Frame) -> Detections:
+        return self.detect_batch([frame])[0]
+
+    def detect(self, video: Video) -> List[Detections]:
+        """Detects cars in a video.
+
+        Args:
+            video: the video to detect cars in.
+
+        Returns:
+            A list with the detections of each frame.
+        """
+        return [detections for _, detections in self.detect_stream(video)]
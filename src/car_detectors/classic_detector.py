@@ -1,49 +1,97 @@
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 
+import math
 import cv2
-from copy import deepcopy
 import numpy as np
 
 from . import CarDetector
-from src.data_structures import Frame, Rectangle, Video
+from src.data_structures import Detections, Frame, Rectangle, Video
 
 
 class ClassicDetector(CarDetector):
     """Classical car detector based on difference between two frames.
 
+    Only the preprocessed grayscale version of the last frame is kept between calls, and the intermediate images
+    of the detection are written into work buffers which are allocated once and reused for every frame.
+
+    The frames can be cropped to an action zone and downscaled before being processed, which reduces the cost of
+    the detection a lot on high resolution videos. The crop is padded by the reach of the morphological operations,
+    and only the cars completely inside the zone are returned, so at scale 1 the detections are the ones of the
+    whole frame which the ``Processor`` keeps for the same action zone. The rectangles are always returned in the
+    coordinates of the full frame.
+
     Args:
-        min_area: minimum area of a rectangle to be considered a car
+        min_area: minimum area of a rectangle to be considered a car, in pixels of the full frame
+        action_zone: the region of the frame where to detect cars, as a rectangle or as a (x, y, width, height)
+            tuple, where the width and the height can be None to reach the edge of the frame, as in ``Processor``.
+            If None, the whole frame is used. Defaults to None.
+        scale: the factor by which the action zone is resized before being processed. The morphological operations
+            work on the resized image, so a small scale also makes them coarser. Defaults to 1.0.
+
+    Raises:
+        ValueError: if scale is not positive
     """
 
-    def __init__(self, min_area: int = 800):
+    context_frames = 1
+    stateful = True
+
+    def __init__(self,
+                 min_area: int = 800,
+                 action_zone: Optional[Union[Rectangle, Tuple[int, int, Optional[int], Optional[int]]]] = None,
+                 scale: float = 1.0):
+        if scale <= 0:
+            raise ValueError(f"The scale must be positive, got {scale}.")
         self.min_area = min_area
-        self.last_frame = None
+        self.action_zone = action_zone
+        self.scale = scale
+        self.last_gray: Optional[np.ndarray] = None
+        self._kernel = np.ones((5, 5), np.uint8)
+        self._buffers: Dict[str, np.ndarray] = {}
+        # The action zone in the coordinates of the last frame preprocessed, and the top left corner of its crop
+        self._zone: Optional[Rectangle] = None
+        self._crop_origin = (0, 0)
 
-    def detect(self, video: Video) -> List[List[Rectangle]]:
+    def detect(self, video: Video) -> List[Detections]:
         """Detects cars in a video.
 
         Args:
             video: the video to detect cars in.
 
         Returns:
-            A list of lists of rectangles. Each list of rectangles represents a frame.
+            A list with the detections of each frame.
         """
-        return [self.detect_frame(frame) for frame in video.frames]
+        return [self.detect_frame(frame) for frame in video]
 
-    def detect_frame(self, frame: Frame) -> List[Rectangle]:
+    def detect_frame(self, frame: Frame) -> Detections:
         """Detects cars in a frame.
 
         Args:
             frame: the frame to detect cars in.
 
         Returns:
-            A list of rectangles.
+            The detected cars.
         """
-        rectangles = self._detect(self.last_frame.image, frame.image) if self.last_frame is not None else []
-        self.last_frame = deepcopy(frame)
-        return rectangles
+        # The two grayscale buffers are used alternately: one holds the last frame and the other the new one
+        gray_buffer = "gray_b" if self.last_gray is self._buffers.get("gray_a") else "gray_a"
+        with self._stage("preprocess"):
+            gray = self._preprocess(frame.image, gray_buffer)
+        with self._stage("find_cars"):
+            detections = Detections.empty() if self.last_gray is None else self._detect_gray(self.last_gray, gray)
+        self.last_gray = gray
+        return detections
+
+    def reset(self) -> None:
+        """Forgets the last frame seen, so the next frame has no frame to be compared with."""
+        self.last_gray = None
+
+    def _buffer(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        """Returns the work buffer with the given name, allocating it if it does not exist or has other shape."""
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffer
 
-    def _detect(self, frame1: np.ndarray, frame2: np.ndarray) -> List[Rectangle]:
+    def _detect(self, frame1: np.ndarray, frame2: np.ndarray) -> Detections:
         """
         Primero, hemos tomado dos frames del video, los pasamos a escala de grises y realizamos la diferencia entre
         estos fotogramas. De esta forma capturamos el movimiento de un frame a otro.
@@ -53,19 +101,95 @@ class ClassicDetector(CarDetector):
         a la imagen para eliminar los píxeles diminutos que existan en la imagen y suavizar los bordes. Por último,
         detectamos el contorno de las 'manchas blancas' y dibujamos un cuadrado alrededor.
         """
-        gray_a = cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY)
-        gray_b = cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)
-        diff_image = cv2.absdiff(gray_b, gray_a)
-        ret, thresh = cv2.threshold(diff_image, 40, 255, cv2.THRESH_BINARY)
-        kernel = np.ones((5, 5), np.uint8)
-        dilated = cv2.dilate(thresh, kernel, iterations=4)
-        filtered = cv2.medianBlur(dilated, 9)
-        contours, hierarchy = cv2.findContours(filtered.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        rectangles = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if cv2.contourArea(contour) < self.min_area:
-                continue
-            rectangles.append(Rectangle(x, y, w, h, label="car"))
-        return rectangles
+        return self._detect_gray(self._preprocess(frame1), self._preprocess(frame2))
+
+    def _detect_gray(self, gray_a: np.ndarray, gray_b: np.ndarray) -> Detections:
+        """Detects cars from two preprocessed grayscale images, as described in ``_detect``."""
+        shape = gray_a.shape
+        diff_image = cv2.absdiff(gray_b, gray_a, dst=self._buffer("diff", shape))
+        cv2.threshold(diff_image, 40, 255, cv2.THRESH_BINARY, dst=diff_image)
+        return self._find_cars(diff_image)
+
+    # Parameters of the morphological operations of ``_find_cars``
+    ITERATIONS = 4
+    MEDIAN_SIZE = 9
+
+    def _reach(self) -> int:
+        """Returns the distance, in pixels of the preprocessed image, up to which the morphological operations of
+        ``_find_cars`` spread the value of a pixel."""
+        return self.ITERATIONS * (self._kernel.shape[0] // 2) + self.MEDIAN_SIZE // 2
+
+    def _find_cars(self, mask: np.ndarray, iterations: Optional[int] = None,
+                   median_size: Optional[int] = None) -> Detections:
+        """Finds the cars in a binary mask of the moving pixels of the preprocessed image.
+
+        Args:
+            mask: the binary mask
+            iterations: the number of times the mask is dilated to join the blobs of a car. If None,
+                ``ITERATIONS``. Defaults to None.
+            median_size: the aperture of the median blur applied after the dilation. If None, ``MEDIAN_SIZE``.
+                Defaults to None.
+        """
+        iterations = self.ITERATIONS if iterations is None else iterations
+        median_size = self.MEDIAN_SIZE if median_size is None else median_size
+        shape = mask.shape
+        dilated = cv2.dilate(mask, self._kernel, dst=self._buffer("dilated", shape), iterations=iterations)
+        filtered = cv2.medianBlur(dilated, median_size, dst=self._buffer("filtered", shape))
+        # Since OpenCV 3.2 findContours does not modify its input
+        contours, hierarchy = cv2.findContours(filtered, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        min_area = self.min_area * self.scale ** 2
+        boxes = [cv2.boundingRect(contour) for contour in contours if cv2.contourArea(contour) >= min_area]
+        detections = Detections(self._to_frame_coordinates(boxes))
+        # The cars crossing the border of the zone are only partially in the crop
+        return detections if self._zone is None else detections[detections.inside(self._zone)]
+
+    def _crop(self, width: int, height: int) -> Tuple[int, int, int, int]:
+        """Returns the (x_min, y_min, x_max, y_max) region of a frame of the given size which is processed: the
+        action zone padded by the reach of the morphological operations, and one more pixel, so that the mask of
+        the zone and of its border is the same as the one of the whole frame."""
+        x, y, w, h = self._zone
+        # Resizing mixes each pixel with its neighbors, and the crop starts at a multiple of the resizing step, so
+        # that the pixels of the resized crop are pixels of the resized frame when the step is an integer
+        step = round(1 / self.scale) if math.isclose(1 / self.scale, round(1 / self.scale)) else 1
+        padding = math.ceil((self._reach() + 1 + (self.scale != 1)) / self.scale)
+        x_min, y_min = max(0, x - padding) // step * step, max(0, y - padding) // step * step
+        return x_min, y_min, min(width, x + w + padding), min(height, y + h + padding)
+
+    def _preprocess(self, image: np.ndarray, buffer: Optional[str] = None) -> np.ndarray:
+        """Crops the image to the action zone, converts it to grayscale and resizes it.
+
+        Args:
+            image: the image to preprocess
+            buffer: the name of the work buffer where to write the result. If None, a new array is returned.
+        """
+        if self.action_zone is not None:
+            height, width = image.shape[:2]
+            x, y, w, h = self.action_zone
+            self._zone = Rectangle(x, y, width - x if w is None else w, height - y if h is None else h)
+            x_min, y_min, x_max, y_max = self._crop(width, height)
+            self._crop_origin = (x_min, y_min)
+            image = image[y_min:y_max, x_min:x_max]
+        height, width = image.shape[:2]
+        if self.scale == 1:
+            dst = self._buffer(buffer, (height, width)) if buffer else None
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
+
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._buffer("gray", (height, width)))
+        # Same rounding as OpenCV when the size is given by the scale factors
+        dst = self._buffer(buffer, (round(height * self.scale), round(width * self.scale))) if buffer else None
+        return cv2.resize(gray, None, dst=dst, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+    def __getstate__(self):
+        # The work buffers are not worth pickling
+        state = self.__dict__.copy()
+        state["_buffers"] = {}
+        return state
+
+    def _to_frame_coordinates(self, boxes: List[Tuple[int, int, int, int]]) -> np.ndarray:
+        """Maps boxes found in the preprocessed image back to the coordinates of the full frame."""
+        boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+        if self.scale != 1:
+            boxes = np.rint(boxes / self.scale)
+        boxes[:, :2] += self._crop_origin
+        return boxes.astype(np.int32)
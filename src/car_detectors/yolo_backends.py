@@ -0,0 +1,396 @@
+"""Inference backends of ``YoloDetector`` and export of YOLOv5 models for them.
+
+A backend takes images and returns, for each image, an array with a (x_min, y_min, x_max, y_max, confidence,
+class id) row per detection in the coordinates of the image. The available backends are:
+
+- ``torch``: the eager model of the torch hub, with its own preprocessing.
+- ``torchscript``: a model traced with ``export_model``.
+- ``onnx``: an ONNX model run by the DNN module of OpenCV, which needs neither torch nor other dependencies.
+- ``onnxruntime``: an ONNX model run by ONNX Runtime, which also runs the int8 quantized models.
+
+Except for ``torch``, the images are letterboxed to a square of ``imgsz`` pixels and the raw output of the model is
+filtered with non-maximum suppression, as YOLOv5 does.
+
+Example:
+    python -m src.car_detectors.yolo_backends yolov5s --format onnx --imgsz 416 --output yolov5s.onnx
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import abc
+import argparse
+import functools
+import json
+import os
+import cv2
+import numpy as np
+
+
+DEFAULT_HUB_REPO = 'ultralytics/yolov5'
+DEFAULT_IMGSZ = 640
+BACKENDS = ("torch", "torchscript", "onnx", "onnxruntime")
+EXPORT_FORMATS = ("torchscript", "onnx")
+
+
+def _resolve_hub_repo(hub_repo: str) -> Tuple[str, str]:
+    """Returns the repository to load the model from and its torch hub source.
+
+    A local directory is used as is, and a GitHub repository already downloaded to the torch hub cache is loaded from
+    the cache, which does not need network access.
+    """
+    import torch
+
+    if os.path.isdir(hub_repo):
+        return hub_repo, 'local'
+    repo_name, _, branch = hub_repo.partition(':')
+    cached_repo = os.path.join(torch.hub.get_dir(), f"{repo_name.replace('/', '_')}_{branch or 'master'}")
+    if os.path.isdir(cached_repo):
+        return cached_repo, 'local'
+    return hub_repo, 'github'
+
+
+@functools.lru_cache(maxsize=None)
+def load_model(yolo_model: str = 'yolov5s', hub_repo: str = DEFAULT_HUB_REPO, autoshape: bool = True):
+    """Loads a YOLOv5 model from the torch hub, only once per process.
+
+    Args:
+        yolo_model: the name of a pretrained model, e.g. 'yolov5s', or the path to a weights file or to a model
+            exported by YOLOv5, e.g. to TorchScript or ONNX.
+        hub_repo: the YOLOv5 repository, as a GitHub repository or a local clone. Defaults to 'ultralytics/yolov5'.
+        autoshape: whether to wrap the model so that it takes images and returns detections. Otherwise, the raw
+            model is returned. Defaults to True.
+
+    Returns:
+        The model, which is shared by every caller with the same arguments.
+    """
+    import torch
+
+    repo, source = _resolve_hub_repo(hub_repo)
+    if os.path.isfile(yolo_model):
+        return torch.hub.load(repo, 'custom', path=yolo_model, source=source, autoshape=autoshape)
+    return torch.hub.load(repo, yolo_model, pretrained=True, source=source, autoshape=autoshape)
+
+
+def _metadata_path(path: str) -> str:
+    return f"{path}.json"
+
+
+def _read_metadata(path: str) -> Dict[str, Any]:
+    """Returns the metadata written by ``export_model`` next to an exported model.
+
+    Raises:
+        ValueError: if the model has no metadata
+    """
+    if not os.path.isfile(_metadata_path(path)):
+        raise ValueError(f"{path} has no metadata file {_metadata_path(path)}, export it with export_model.")
+    with open(_metadata_path(path)) as file:
+        return json.load(file)
+
+
+def letterbox(image: np.ndarray, imgsz: int) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """Resizes the image to fit in a square of imgsz pixels keeping its aspect ratio, and pads it with gray.
+
+    Returns:
+        The square image, the scale applied and the (x, y) padding added to the top left corner.
+    """
+    height, width = image.shape[:2]
+    scale = min(imgsz / height, imgsz / width)
+    new_width, new_height = round(width * scale), round(height * scale)
+    pad_x, pad_y = (imgsz - new_width) // 2, (imgsz - new_height) // 2
+    square = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    square[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = cv2.resize(image, (new_width, new_height),
+                                                                           interpolation=cv2.INTER_LINEAR)
+    return square, scale, (pad_x, pad_y)
+
+
+def non_max_suppression(output: np.ndarray,
+                        min_confidence: float,
+                        iou_threshold: float = 0.45,
+                        max_detections: int = 300) -> np.ndarray:
+    """Filters the raw output of YOLOv5 for an image.
+
+    Args:
+        output: array with a (x_center, y_center, width, height, objectness, class scores...) row per anchor
+        min_confidence: the minimum confidence, objectness times class score, of a detection
+        iou_threshold: the maximum intersection over union of two detections of the same class. Defaults to 0.45.
+        max_detections: the maximum number of detections kept. Defaults to 300.
+
+    Returns:
+        An array with a (x_min, y_min, x_max, y_max, confidence, class id) row per detection, by confidence.
+    """
+    output = output[output[:, 4] >= min_confidence]
+    class_scores = output[:, 5:] * output[:, 4:5]
+    class_ids = class_scores.argmax(axis=1)
+    confidences = class_scores[np.arange(len(output)), class_ids]
+    keep = confidences >= min_confidence
+    output, class_ids, confidences = output[keep], class_ids[keep], confidences[keep]
+
+    boxes = np.empty((len(output), 4), dtype=np.float32)
+    boxes[:, :2] = output[:, :2] - output[:, 2:4] / 2
+    boxes[:, 2:] = output[:, 2:4]
+    # The boxes of each class are moved far from the others, so that a single NMS never suppresses a box with a box
+    # of another class
+    offsets = class_ids[:, None].astype(np.float32) * (float(np.abs(boxes).max(initial=0)) * 2 + 1)
+    shifted_boxes = boxes.copy()
+    shifted_boxes[:, :2] += offsets
+    indices = np.asarray(cv2.dnn.NMSBoxes(shifted_boxes.tolist(), confidences.tolist(), min_confidence,
+                                          iou_threshold, top_k=max_detections),
+                         dtype=np.int64).reshape(-1)
+    boxes = boxes[indices]
+    boxes[:, 2:] += boxes[:, :2]
+    return np.column_stack([boxes, confidences[indices], class_ids[indices]]).astype(np.float32)
+
+
+class YoloBackend(abc.ABC):
+    """Base class of the inference backends.
+
+    Attributes:
+        names: the name of each class id of the model.
+        imgsz: the size of the longest side of the images given to the model, to which every image is resized.
+    """
+
+    names: Dict[int, str]
+    imgsz: int
+
+    @abc.abstractmethod
+    def predict(self, images: Sequence[np.ndarray], min_confidence: float = 0.25) -> List[np.ndarray]:
+        """Detects objects in BGR images.
+
+        Args:
+            images: the images
+            min_confidence: the minimum confidence of a detection. Defaults to 0.25.
+
+        Returns:
+            For each image, an array with a (x_min, y_min, x_max, y_max, confidence, class id) row per detection.
+        """
+
+    def set_num_threads(self, n_threads: int) -> None:
+        """Sets the number of threads used for inference."""
+        cv2.setNumThreads(n_threads)
+
+
+class TorchHubBackend(YoloBackend):
+    """The eager model of the torch hub, which takes the images as they are and preprocesses them itself.
+
+    Args:
+        yolo_model: the name of a pretrained model or the path to a weights file
+        hub_repo: the YOLOv5 repository, as a GitHub repository or a local clone
+        imgsz: the size of the longest side of the images given to the model. Defaults to 640.
+    """
+
+    def __init__(self, yolo_model: str, hub_repo: str = DEFAULT_HUB_REPO, imgsz: int = DEFAULT_IMGSZ):
+        self.model = load_model(yolo_model, hub_repo)
+        self.imgsz = imgsz
+        names = self.model.names
+        self.names = dict(enumerate(names)) if isinstance(names, (list, tuple)) else dict(names)
+
+    def predict(self, images: Sequence[np.ndarray], min_confidence: float = 0.25) -> List[np.ndarray]:
+        # The model is shared by every detector with the same weights, so its threshold is set before every call
+        self.model.conf = min_confidence
+        # AutoShape expects RGB images
+        results = self.model([image[..., ::-1] for image in images], size=self.imgsz)
+        return [predictions.cpu().numpy() for predictions in results.xyxy]
+
+    def set_num_threads(self, n_threads: int) -> None:
+        import torch
+
+        torch.set_num_threads(n_threads)
+
+
+class _LetterboxBackend(YoloBackend):
+    """Backend for models exported with ``export_model``, which take letterboxed images and return the raw output.
+
+    Args:
+        path: the path to the exported model
+        imgsz: the size of the square images given to the model. If None, the size it was exported with is used.
+            ONNX models must be used with that size. Defaults to None.
+    """
+
+    def __init__(self, path: str, imgsz: Optional[int] = None):
+        metadata = _read_metadata(path)
+        self.names = {int(class_id): name for class_id, name in metadata["names"].items()}
+        self.imgsz = imgsz or metadata["imgsz"]
+
+    @abc.abstractmethod
+    def _forward(self, blob: np.ndarray) -> np.ndarray:
+        """Runs the model on a (N, 3, imgsz, imgsz) batch of images and returns its (N, anchors, 5 + classes)
+        output."""
+
+    def predict(self, images: Sequence[np.ndarray], min_confidence: float = 0.25) -> List[np.ndarray]:
+        if not images:
+            return []
+        letterboxed = [letterbox(image, self.imgsz) for image in images]
+        blob = cv2.dnn.blobFromImages([square for square, _, _ in letterboxed], 1 / 255, swapRB=True)
+        predictions_in_images = []
+        for image, (_, scale, (pad_x, pad_y)), output in zip(images, letterboxed, self._forward(blob)):
+            predictions = non_max_suppression(output, min_confidence)
+            predictions[:, [0, 2]] = np.clip((predictions[:, [0, 2]] - pad_x) / scale, 0, image.shape[1])
+            predictions[:, [1, 3]] = np.clip((predictions[:, [1, 3]] - pad_y) / scale, 0, image.shape[0])
+            predictions_in_images.append(predictions)
+        return predictions_in_images
+
+
+class TorchScriptBackend(_LetterboxBackend):
+    """A YOLOv5 model traced to TorchScript with ``export_model``."""
+
+    def __init__(self, path: str, imgsz: Optional[int] = None):
+        import torch
+
+        super().__init__(path, imgsz)
+        self.model = torch.jit.load(path, map_location="cpu").eval()
+
+    def _forward(self, blob: np.ndarray) -> np.ndarray:
+        import torch
+
+        with torch.inference_mode():
+            output = self.model(torch.from_numpy(blob))
+        return (output[0] if isinstance(output, (list, tuple)) else output).numpy()
+
+    def set_num_threads(self, n_threads: int) -> None:
+        import torch
+
+        torch.set_num_threads(n_threads)
+
+
+class OpenCVOnnxBackend(_LetterboxBackend):
+    """A YOLOv5 model exported to ONNX with ``export_model``, run by the DNN module of OpenCV.
+
+    The images are given to the model one at a time, since ONNX models are exported with a batch size of 1.
+    """
+
+    def __init__(self, path: str, imgsz: Optional[int] = None):
+        super().__init__(path, imgsz)
+        self.net = cv2.dnn.readNetFromONNX(path)
+
+    def _forward(self, blob: np.ndarray) -> np.ndarray:
+        outputs = []
+        for image_blob in blob:
+            self.net.setInput(image_blob[None])
+            outputs.append(self.net.forward()[0])
+        return np.stack(outputs)
+
+
+class OnnxRuntimeBackend(_LetterboxBackend):
+    """A YOLOv5 model exported to ONNX with ``export_model``, possibly quantized to int8, run by ONNX Runtime.
+
+    Raises:
+        ImportError: if ONNX Runtime is not installed
+    """
+
+    def __init__(self, path: str, imgsz: Optional[int] = None):
+        import onnxruntime
+
+        super().__init__(path, imgsz)
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _forward(self, blob: np.ndarray) -> np.ndarray:
+        return np.stack([self.session.run(None, {self.input_name: image_blob[None]})[0][0] for image_blob in blob])
+
+
+def infer_backend(yolo_model: str) -> str:
+    """Returns the backend for a model: the one it was exported for, or ``torch`` for models of the torch hub."""
+    if os.path.isfile(_metadata_path(yolo_model)):
+        return _read_metadata(yolo_model)["backend"]
+    return "torch"
+
+
+@functools.lru_cache(maxsize=None)
+def load_backend(backend: str,
+                 yolo_model: str,
+                 imgsz: Optional[int] = None,
+                 hub_repo: str = DEFAULT_HUB_REPO) -> YoloBackend:
+    """Loads a model in a backend, only once per process.
+
+    Args:
+        backend: one of ``BACKENDS``
+        yolo_model: the name of a pretrained model or the path to a model file for the backend
+        imgsz: the size of the images given to the model. If None, the default of the backend is used.
+            Defaults to None.
+        hub_repo: the YOLOv5 repository. Only used by the ``torch`` backend. Defaults to 'ultralytics/yolov5'.
+
+    Raises:
+        ValueError: if the backend is not known
+    """
+    if backend == "torch":
+        return TorchHubBackend(yolo_model, hub_repo, imgsz or DEFAULT_IMGSZ)
+    if backend == "torchscript":
+        return TorchScriptBackend(yolo_model, imgsz)
+    if backend == "onnx":
+        return OpenCVOnnxBackend(yolo_model, imgsz)
+    if backend == "onnxruntime":
+        return OnnxRuntimeBackend(yolo_model, imgsz)
+    raise ValueError(f"Unknown backend {backend}, it must be one of {BACKENDS}.")
+
+
+def export_model(yolo_model: str,
+                 path: str,
+                 export_format: str = "onnx",
+                 imgsz: int = DEFAULT_IMGSZ,
+                 int8: bool = False,
+                 hub_repo: str = DEFAULT_HUB_REPO) -> None:
+    """Exports a YOLOv5 model of the torch hub for a faster backend.
+
+    The metadata needed by the backend, like the names of the classes, is written next to the model, in a file
+    with the same path followed by ``.json``.
+
+    Args:
+        yolo_model: the name of a pretrained model or the path to a weights file
+        path: the path of the exported model
+        export_format: one of ``EXPORT_FORMATS``. Defaults to "onnx".
+        imgsz: the size of the square images the model takes. Defaults to 640.
+        int8: whether to quantize the weights of an ONNX model to int8, which needs ONNX Runtime. Defaults to
+            False.
+        hub_repo: the YOLOv5 repository, as a GitHub repository or a local clone. Defaults to 'ultralytics/yolov5'.
+
+    Raises:
+        ValueError: if the format is not known or int8 is used with TorchScript
+    """
+    import torch
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format {export_format}, it must be one of {EXPORT_FORMATS}.")
+    if int8 and export_format != "onnx":
+        raise ValueError("Only ONNX models can be quantized to int8.")
+
+    model = load_model(yolo_model, hub_repo, autoshape=False).float().eval()
+    for module in model.modules():
+        # The detection head returns only its concatenated output, as in the exports of YOLOv5
+        if type(module).__name__ == "Detect":
+            module.inplace = False
+            module.export = True
+    names = model.names if isinstance(model.names, dict) else dict(enumerate(model.names))
+    images = torch.zeros(1, 3, imgsz, imgsz)
+
+    backend = export_format
+    if export_format == "torchscript":
+        torch.jit.trace(model, images, strict=False).save(path)
+    else:
+        onnx_path = f"{path}.fp32.onnx" if int8 else path
+        torch.onnx.export(model, images, onnx_path, opset_version=12, input_names=["images"], output_names=["output"])
+        if int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(onnx_path, path, weight_type=QuantType.QUInt8)
+            os.remove(onnx_path)
+            # OpenCV does not run dynamically quantized models
+            backend = "onnxruntime"
+
+    with open(_metadata_path(path), "w") as file:
+        json.dump({"backend": backend, "imgsz": imgsz, "names": {str(i): name for i, name in names.items()}}, file)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Exports a YOLOv5 model for a faster inference backend.")
+    parser.add_argument("yolo_model", help="name of a pretrained model, e.g. yolov5s, or path to a weights file")
+    parser.add_argument("--output", required=True, help="path of the exported model")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="onnx")
+    parser.add_argument("--imgsz", type=int, default=DEFAULT_IMGSZ, help="size of the square input images")
+    parser.add_argument("--int8", action="store_true", help="quantize the weights to int8 (onnx, needs onnxruntime)")
+    parser.add_argument("--hub-repo", default=DEFAULT_HUB_REPO, help="YOLOv5 GitHub repository or local clone")
+    args = parser.parse_args(argv)
+    export_model(args.yolo_model, args.output, args.format, args.imgsz, args.int8, args.hub_repo)
+    print(f"Exported {args.yolo_model} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,133 @@
-from typing import List
+from typing import Any, Dict, List, Optional, Sequence
 
-import torch
+import numpy as np
 
 from src.car_detectors.car_detector import CarDetector
-from src.data_structures import Frame, Rectangle, Video
+from src.car_detectors.yolo_backends import DEFAULT_HUB_REPO, YoloBackend, infer_backend, load_backend
+from src.data_structures import Detections, Frame, Video
 
 
 class YoloDetector(CarDetector):
     """Car detector based on YOLOv5 model.
 
+    A single copy of the model is used from the main process: frames are processed in micro-batches and the model
+    parallelizes each batch with its own threads.
+
+    The model runs in one of the backends of ``yolo_backends``: the eager model of the torch hub, or a model exported
+    with ``yolo_backends.export_model`` to TorchScript or ONNX, which are usually faster on CPU, especially with
+    a small ``imgsz``. The ONNX backend of OpenCV does not even need torch.
+
+    The models are loaded with ``yolo_backends.load_backend``, so the detectors of a process which use the same model
+    share it, and a pickled detector only holds its parameters and loads the model again when it is unpickled.
+
     Args:
-        yolo_model: the YOLOv5 model to use. Can be one of 'yolov5s', 'yolov5m', 'yolov5l', 'yolov5x'.
+        yolo_model: the YOLOv5 model to use. Can be one of 'yolov5s', 'yolov5m', 'yolov5l', 'yolov5x', the path
+            to a weights file, or the path to a model exported with ``yolo_backends.export_model``.
+        batch_size: the number of frames passed to the model at once by ``detect_stream`` and ``detect``. Memory
+            grows with it. Defaults to 16.
+        n_threads: the number of threads used by the backend. If None, its default is kept. Defaults to None.
+        classes: the names of the classes to keep. If None, detections of every class are kept. Defaults to
+            ("car",).
+        min_confidence: the minimum confidence of a detection to be kept. Defaults to 0.25.
+        hub_repo: the YOLOv5 repository, as a GitHub repository or a local clone. Once downloaded, a GitHub
+            repository is loaded from the torch hub cache. Only used by the torch backend. Defaults to
+            'ultralytics/yolov5'.
+        backend: the backend to run the model in, one of ``yolo_backends.BACKENDS``. If None, the backend the
+            model was exported for is used, or the torch backend for models of the torch hub. Defaults to None.
+        imgsz: the size of the images given to the model. Smaller sizes are faster but miss small cars. If None,
+            the size the model was exported with is used, or 640 for models of the torch hub. Defaults to None.
+
+    Raises:
+        ValueError: if one of the classes is not known by the model or the backend is not known
     """
 
-    def __init__(self, yolo_model: str = 'yolov5s'):
-        self.model = torch.hub.load('ultralytics/yolov5', yolo_model, pretrained=True)
+    supports_multiprocessing = False
+    execution_parameters = ("batch_size", "n_threads")
+
+    def __init__(self,
+                 yolo_model: str = 'yolov5s',
+                 batch_size: int = 16,
+                 n_threads: Optional[int] = None,
+                 classes: Optional[Sequence[str]] = ("car",),
+                 min_confidence: float = 0.25,
+                 hub_repo: str = DEFAULT_HUB_REPO,
+                 backend: Optional[str] = None,
+                 imgsz: Optional[int] = None):
+        self.backend = backend
+        self.model: YoloBackend = load_backend(backend or infer_backend(yolo_model), yolo_model, imgsz, hub_repo)
+        self.input_size = self.model.imgsz
+        self.yolo_model = yolo_model
+        self.hub_repo = hub_repo
+        self.imgsz = imgsz
+        self.classes = tuple(classes) if classes is not None else None
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+        self.min_confidence = min_confidence
+        if n_threads is not None:
+            self.model.set_num_threads(n_threads)
 
-    @staticmethod
-    def _parse_results(results) -> List[Rectangle]:
-        rectangles = []
-        for x_min, y_min, x_max, y_max, _, _, name in results.pandas().xyxy[0].to_numpy():
-            w = round(x_max - x_min)
-            h = round(y_max - y_min)
-            rectangles.append(Rectangle(round(x_min), round(y_min), w, h,
-                                        label=f"{name}"))
+        self.names: Dict[int, str] = self.model.names
+        self.labels = tuple(self.names.get(class_id, str(class_id)) for class_id in range(max(self.names) + 1))
+        self.class_ids: Optional[np.ndarray] = None
+        if classes is not None:
+            name_to_id = {name: class_id for class_id, name in self.names.items()}
+            unknown_classes = [name for name in classes if name not in name_to_id]
+            if unknown_classes:
+                raise ValueError(f"Unknown classes for model {yolo_model}: {unknown_classes}")
+            self.class_ids = np.array([name_to_id[name] for name in classes], dtype=np.int64)
+
+    def _parse_predictions(self, predictions: np.ndarray) -> Detections:
+        """Converts the predictions of the model for an image into detections.
+
+        Args:
+            predictions: an array with a (x_min, y_min, x_max, y_max, confidence, class id) row per detection
+
+        Returns:
+            The detections of the wanted classes with enough confidence.
+        """
+        class_ids = predictions[:, 5].astype(np.int64)
+        keep = predictions[:, 4] >= self.min_confidence
+        if self.class_ids is not None:
+            keep &= np.isin(class_ids, self.class_ids)
 
-        return rectangles
+        boxes = predictions[keep, :4].copy()
+        boxes[:, 2:] -= boxes[:, :2]
+        return Detections(np.rint(boxes), class_ids[keep], predictions[keep, 4], self.labels)
 
-    def detect(self, video: Video) -> List[List[Rectangle]]:
+    def detect(self, video: Video) -> List[Detections]:
         """Detects cars in a video.
 
+        The frames are decoded and passed to the model ``batch_size`` at a time.
+
         Args:
             video: the video to detect cars in.
 
         Returns:
-            A list of lists of rectangles. Each list of rectangles represents a frame.
+            A list with the detections of each frame.
+        """
+        return [detections for _, detections in self.detect_stream(video)]
+
+    def detect_batch(self, frames: Sequence[Frame]) -> List[Detections]:
+        """Detects cars in several frames with a single call to the model.
+
+        Args:
+            frames: the frames to detect cars in.
+
+        Returns:
+            A list with the detections of each frame.
         """
-        images = [frame.image for frame in video.frames]
-        results = self.model.forward(images)
-        return [self._parse_results(result) for result in results]
+        if not frames:
+            return []
+        with self._stage("inference"):
+            predictions_in_frames = self.model.predict([frame.image for frame in frames], self.min_confidence)
+        return [self._parse_predictions(predictions) for predictions in predictions_in_frames]
+
+    def detect_frame(self, frame: Frame) -> Detections:
+        return self.detect_batch([frame])[0]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Only the parameters are pickled, the model is loaded again from the cache of the process
+        return {**self.config(), **{name: getattr(self, name) for name in self.execution_parameters}}
 
-    def detect_frame(self, frame: Frame) -> List[Rectangle]:
-        results = self.model(frame.image)
-        return self._parse_results(results)
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(**state)
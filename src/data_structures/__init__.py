@@ -1,3 +1,8 @@
 from .frame import Frame
 from .video import Video
+from .frame_store import FrameStore
+from .video_writer import VideoWriter
 from .rectangle import Point, Color, Rectangle
+from .detections import Detections
+from .shared_frame_buffer import SharedFrameBuffer
+from .processing_result import ProcessingResult
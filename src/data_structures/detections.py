@@ -0,0 +1,161 @@
+"""Contains the definition of the Detections class"""
+from typing import Iterable, Iterator, List, Sequence, Tuple, Union
+
+from dataclasses import dataclass
+import numpy as np
+
+from .rectangle import Rectangle
+
+
+@dataclass(frozen=True, eq=False)
+class Detections:
+    """The objects detected in a frame, stored column-wise in NumPy arrays.
+
+    It behaves as a sequence of rectangles, which are created on demand, while the operations that detectors,
+    trackers and processors need (filtering by zone or label, centers, distances) are computed at once for all the
+    detections of the frame.
+
+    Args:
+        boxes: array with shape (N, 4) with the x, y, width and height of each detection
+        class_ids: array with shape (N,) with the index in ``labels`` of the label of each detection. Defaults to
+            zeros.
+        scores: array with shape (N,) with the confidence of each detection. Defaults to ones.
+        labels: the label of each class id. Defaults to ("car",).
+
+    Examples:
+        >>> detections = Detections([[0, 0, 10, 10], [50, 50, 20, 10]])
+        >>> len(detections)
+        2
+        >>> detections[1]
+        Rectangle(x=50, y=50, width=20, height=10, label='car')
+        >>> detections.centers.tolist()
+        [[5, 5], [60, 55]]
+        >>> zone = Rectangle(0, 0, 40, 40)
+        >>> detections[detections.inside(zone)].to_rectangles()
+        [Rectangle(x=0, y=0, width=10, height=10, label='car')]
+        >>> mixed = Detections.from_rectangles([Rectangle(0, 0, 1, 1, "truck"), Rectangle(2, 2, 1, 1, "car")])
+        >>> mixed.with_label("car").tolist()
+        [False, True]
+    """
+
+    boxes: np.ndarray
+    class_ids: np.ndarray = None
+    scores: np.ndarray = None
+    labels: Tuple[str, ...] = ("car",)
+
+    def __post_init__(self):
+        boxes = np.asarray(self.boxes, dtype=np.int32).reshape(-1, 4)
+        n_detections = len(boxes)
+        class_ids = (np.zeros(n_detections, dtype=np.int32) if self.class_ids is None
+                     else np.asarray(self.class_ids, dtype=np.int32).reshape(n_detections))
+        scores = (np.ones(n_detections, dtype=np.float32) if self.scores is None
+                  else np.asarray(self.scores, dtype=np.float32).reshape(n_detections))
+        object.__setattr__(self, "boxes", boxes)
+        object.__setattr__(self, "class_ids", class_ids)
+        object.__setattr__(self, "scores", scores)
+        object.__setattr__(self, "labels", tuple(self.labels))
+
+    @classmethod
+    def empty(cls, labels: Sequence[str] = ("car",)) -> "Detections":
+        """Returns a Detections object without detections."""
+        return cls(np.empty((0, 4), dtype=np.int32), labels=tuple(labels))
+
+    @classmethod
+    def from_rectangles(cls, rectangles: Iterable[Rectangle]) -> "Detections":
+        """Creates a Detections object from rectangles. If they are already a Detections object, it is returned."""
+        if isinstance(rectangles, cls):
+            return rectangles
+        rectangles = list(rectangles)
+        labels = tuple(dict.fromkeys(rectangle.label for rectangle in rectangles)) or ("car",)
+        label_ids = {label: i for i, label in enumerate(labels)}
+        boxes = np.array([tuple(rectangle) for rectangle in rectangles], dtype=np.int32)
+        class_ids = np.array([label_ids[rectangle.label] for rectangle in rectangles], dtype=np.int32)
+        return cls(boxes, class_ids, labels=labels)
+
+    @classmethod
+    def concatenate(cls, detections_list: Sequence["Detections"]) -> Tuple["Detections", np.ndarray]:
+        """Concatenates the detections of several frames into a single object, e.g. to send them to other process.
+
+        Args:
+            detections_list: the detections to concatenate
+
+        Returns:
+            The concatenated detections and the number of detections of each of the original objects, which can be
+            given to ``split`` to recover them.
+        """
+        labels = tuple(dict.fromkeys(label for detections in detections_list for label in detections.labels))
+        labels = labels or ("car",)
+        label_ids = {label: i for i, label in enumerate(labels)}
+        class_ids = [np.array([label_ids[label] for label in detections.labels], dtype=np.int32)[detections.class_ids]
+                     for detections in detections_list]
+        counts = np.array([len(detections) for detections in detections_list], dtype=np.int64)
+        if not detections_list:
+            return cls.empty(labels), counts
+        concatenated = cls(np.concatenate([detections.boxes for detections in detections_list]),
+                           np.concatenate(class_ids),
+                           np.concatenate([detections.scores for detections in detections_list]),
+                           labels)
+        return concatenated, counts
+
+    def split(self, counts: Sequence[int]) -> List["Detections"]:
+        """Inverse of ``concatenate``: splits the detections into consecutive groups of the given sizes."""
+        offsets = np.cumsum(counts)[:-1]
+        return [Detections(boxes, class_ids, scores, self.labels)
+                for boxes, class_ids, scores in zip(np.split(self.boxes, offsets),
+                                                     np.split(self.class_ids, offsets),
+                                                     np.split(self.scores, offsets))]
+
+    @property
+    def centers(self) -> np.ndarray:
+        """Array with shape (N, 2) with the center of each detection, computed as ``Rectangle.center``."""
+        return self.boxes[:, :2] + self.boxes[:, 2:] // 2
+
+    def inside(self, zone: Rectangle) -> np.ndarray:
+        """Returns a boolean mask of the detections that are completely inside the zone, as ``rectangle in zone``."""
+        x, y, w, h = zone
+        top_left = self.boxes[:, :2]
+        bottom_right = top_left + self.boxes[:, 2:]
+        lower_bound = np.array([x, y])
+        upper_bound = np.array([x + w, y + h])
+        return np.all((top_left >= lower_bound) & (top_left <= upper_bound)
+                      & (bottom_right >= lower_bound) & (bottom_right <= upper_bound), axis=1)
+
+    def with_label(self, text: str) -> np.ndarray:
+        """Returns a boolean mask of the detections whose label contains the text, ignoring case."""
+        text = text.lower()
+        matching_labels = np.array([text in label.lower() for label in self.labels], dtype=bool)
+        return matching_labels[self.class_ids]
+
+    def distances_to(self, points: np.ndarray) -> np.ndarray:
+        """Computes the distances between the center of each detection and each point.
+
+        Args:
+            points: array with shape (M, 2)
+
+        Returns:
+            An array with shape (N, M).
+        """
+        differences = self.centers[:, None, :] - np.asarray(points).reshape(-1, 2)[None, :, :]
+        return np.hypot(differences[..., 0], differences[..., 1])
+
+    def to_rectangles(self) -> List[Rectangle]:
+        return list(self)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self) -> Iterator[Rectangle]:
+        for (x, y, w, h), class_id in zip(self.boxes.tolist(), self.class_ids.tolist()):
+            yield Rectangle(x, y, w, h, label=self.labels[class_id])
+
+    def __getitem__(self, item: Union[int, slice, np.ndarray]) -> Union[Rectangle, "Detections"]:
+        if isinstance(item, (int, np.integer)):
+            x, y, w, h = self.boxes[item].tolist()
+            return Rectangle(x, y, w, h, label=self.labels[self.class_ids[item]])
+        return Detections(self.boxes[item], self.class_ids[item], self.scores[item], self.labels)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
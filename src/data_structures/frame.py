@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Sequence
 
 import cv2
 from dataclasses import dataclass, field
@@ -87,6 +87,35 @@ class Frame:
         """
         cv2.line(self.image, start, end, color, thickness)
 
+    def draw_polygon(self,
+                     points: Sequence[Point],
+                     color: Color = (0, 255, 0),
+                     thickness: int = 2,
+                     closed: bool = True):
+        """Draws the polygon on the frame.
+
+        Args:
+            points: the vertices of the polygon
+            color: the color of the polygon. Defaults to (0, 255, 0) (green).
+            thickness: the thickness of the polygon. Defaults to 2.
+            closed: whether to join the last vertex with the first one. Defaults to True.
+        """
+        cv2.polylines(self.image, [np.array(points, dtype=np.int32)], closed, color, thickness)
+
+    def draw_polylines(self,
+                       polylines: Sequence[np.ndarray],
+                       color: Color = (0, 255, 0),
+                       thickness: int = 2):
+        """Draws several open polylines on the frame at once.
+
+        Args:
+            polylines: an int32 array with shape (N, 2) with the points of each polyline
+            color: the color of the polylines. Defaults to (0, 255, 0) (green).
+            thickness: the thickness of the polylines. Defaults to 2.
+        """
+        if polylines:
+            cv2.polylines(self.image, list(polylines), False, color, thickness)
+
     def save(self, path: str):
         cv2.imwrite(path, self.image)
 
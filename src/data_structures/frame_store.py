@@ -0,0 +1,169 @@
+"""Contains the definition of the FrameStore class"""
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import os
+import struct
+import numpy as np
+
+from .frame import Frame
+
+
+class FrameStore(Sequence[Frame]):
+    """The decoded frames of a video, stored as raw pixels in a file which is memory-mapped.
+
+    Decoding a video takes much longer than reading its pixels, so a video which is processed many times, e.g. to
+    tune the parameters of a detector, can be decoded once into a store and then opened instantly. The file starts
+    with a small header with the shape of the frames, the frames per second, the number of frames and the path, size
+    and modification time of the video the frames were decoded from, followed by the pixels of the frames one after
+    the other. See ``is_store_of`` to check whether a store was decoded from a video which has not changed since.
+
+    The frames are read-only views of the file and are only read from disk when they are used, so a store takes
+    almost no memory, and all the processes that open the same store share its pixels through the page cache.
+    Indexing a store gives a frame, and slicing it gives another store with the selected frames, without copy. A
+    store can be pickled, e.g. to send it to a worker process, and the process opens the file again.
+
+    Args:
+        path: the path of the store, which must exist. See ``create`` to create one.
+
+    Raises:
+        ValueError: if the file is not a frame store or is incomplete
+
+    Examples:
+        >>> import tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "video.frames")
+        >>> frames = [Frame(np.full((4, 6, 3), i, dtype=np.uint8)) for i in range(5)]
+        >>> store = FrameStore.create(path, frames, fps=25)
+        >>> len(store), store.fps, store[-1].image[0, 0].tolist(), store.source
+        (5, 25.0, [4, 4, 4], None)
+        >>> [int(frame.image[0, 0, 0]) for frame in store[1:5:2]]
+        [1, 3]
+    """
+
+    MAGIC = b"CARFRMS2"
+    # Magic, height, width, channels, number of frames, frames per second, and size, modification time in
+    # nanoseconds and length of the path of the source video, followed by the path and padded to a multiple of 64
+    # bytes
+    HEADER = struct.Struct("<8sIIIQdQqI")
+    HEADER_ALIGNMENT = 64
+
+    def __init__(self, path: str, _frame_range: Optional[slice] = None):
+        self.path = path
+        with open(path, "rb") as file:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size or header[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError(f"{path} is not a frame store.")
+            (_, height, width, channels, frame_count, fps, source_size, source_mtime_ns,
+             source_path_length) = self.HEADER.unpack(header)
+            source_path = file.read(source_path_length).decode()
+        frame_shape = (height, width, channels)
+        header_size = self._header_size(source_path_length)
+        if os.path.getsize(path) != header_size + frame_count * int(np.prod(frame_shape)):
+            raise ValueError(f"The frame store {path} is incomplete.")
+
+        self.fps = fps
+        self.frame_count = frame_count
+        # The path, size and modification time of the video the frames were decoded from, if known
+        self.source: Optional[Tuple[str, int, int]] = ((source_path, source_size, source_mtime_ns) if source_path
+                                                       else None)
+        self._frame_range = slice(None) if _frame_range is None else _frame_range
+        images = (np.memmap(path, dtype=np.uint8, mode="r", offset=header_size, shape=(frame_count, *frame_shape))
+                  if frame_count else np.empty((0, *frame_shape), dtype=np.uint8))
+        self.images: np.ndarray = images[self._frame_range]
+
+    @property
+    def size(self):
+        return self.images.shape[2], self.images.shape[1]
+
+    @classmethod
+    def _header_size(cls, source_path_length: int) -> int:
+        size = cls.HEADER.size + source_path_length
+        return -(-size // cls.HEADER_ALIGNMENT) * cls.HEADER_ALIGNMENT
+
+    @staticmethod
+    def _describe_source(source_path: str) -> Tuple[str, int, int]:
+        """Returns the real path, size and modification time in nanoseconds of a file."""
+        stat = os.stat(source_path)
+        return os.path.realpath(source_path), stat.st_size, stat.st_mtime_ns
+
+    def is_store_of(self, source_path: str) -> bool:
+        """Returns whether the frames of the store were decoded from the file, which has not been modified since.
+
+        Args:
+            source_path: the path of the video
+
+        Returns:
+            False if the store was decoded from another file, or from the same file with another size or
+            modification time, or if its source is not known.
+        """
+        return self.source is not None and self.source == self._describe_source(source_path)
+
+    @classmethod
+    def create(cls, path: str, frames: Iterable[Frame], fps: float, source_path: Optional[str] = None) -> "FrameStore":
+        """Writes the frames to a new store and opens it.
+
+        The store is written to a temporary file which is renamed when it is complete, so a store is never left half
+        written and processes which open it at the same time never see an incomplete one.
+
+        Args:
+            path: the path of the store. If it exists, it is replaced.
+            frames: the frames to store. They must all have the same shape.
+            fps: the frames per second of the video
+            source_path: the path of the video the frames are decoded from, whose path, size and modification time
+                are stored so that ``is_store_of`` can check it later. It must not be modified while it is decoded.
+                Defaults to None.
+
+        Returns:
+            The new store.
+
+        Raises:
+            ValueError: if the frames do not all have the same shape
+        """
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        frame_shape, frame_count = (0, 0, 3), 0
+        source_path, source_size, source_mtime_ns = (cls._describe_source(source_path) if source_path is not None
+                                                     else ("", 0, 0))
+        encoded_source_path = source_path.encode()
+        try:
+            with open(temporary_path, "wb") as file:
+                file.write(bytes(cls._header_size(len(encoded_source_path))))
+                for frame in frames:
+                    if frame_count == 0:
+                        frame_shape = frame.image.shape
+                    elif frame.image.shape != frame_shape:
+                        raise ValueError(f"All the frames must have the shape {frame_shape}, "
+                                         f"got {frame.image.shape}.")
+                    file.write(np.ascontiguousarray(frame.image, dtype=np.uint8).data)
+                    frame_count += 1
+                file.seek(0)
+                file.write(cls.HEADER.pack(cls.MAGIC, *frame_shape, frame_count, fps, source_size, source_mtime_ns,
+                                           len(encoded_source_path)))
+                file.write(encoded_source_path)
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return cls(path)
+
+    def __getitem__(self, item: Union[int, slice]) -> Union[Frame, "FrameStore"]:
+        if isinstance(item, slice):
+            # The range is kept relative to the whole file, so that the view can be opened again after pickling
+            indices = range(*self._frame_range.indices(self.frame_count))[item]
+            return FrameStore(self.path, slice(indices.start, indices.stop if indices.stop >= 0 else None,
+                                               indices.step))
+        return Frame(self.images[item])
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __iter__(self) -> Iterator[Frame]:
+        for image in self.images:
+            yield Frame(image)
+
+    def __reduce__(self):
+        return FrameStore, (self.path, self._frame_range)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,142 @@
+"""Contains the definition of the ProcessingResult class"""
+from typing import Any, Dict, List
+
+from dataclasses import dataclass, field
+import json
+import numpy as np
+
+from .detections import Detections
+
+
+@dataclass
+class ProcessingResult:
+    """The cars tracked in every frame of a video, without any image.
+
+    The cars of all the frames are stored concatenated, and ``frame_offsets`` gives where the cars of each frame
+    start and end, so the whole result takes a few compact arrays.
+
+    Args:
+        detections: the cars tracked in each frame, concatenated
+        trace_ids: array with shape (N,) with the id of the trace of each car
+        frame_offsets: array with shape (F + 1,) such that the cars of frame i are
+            ``detections[frame_offsets[i]:frame_offsets[i + 1]]``
+        detected: array with shape (F,) with whether the car detector ran in each frame. In the other frames the
+            cars are the positions predicted by the tracker.
+        car_counter: the final value of the car counter
+        zone_counts: the final number of cars counted in each zone. Defaults to an empty dict.
+        fps: the frames per second of the video. Defaults to 30.
+
+    Examples:
+        >>> result = ProcessingResult(Detections([[0, 0, 10, 10], [5, 0, 10, 10], [50, 50, 20, 10]]),
+        ...                           np.array([1, 1, 2]), np.array([0, 1, 3]), np.array([True, False]), 2)
+        >>> len(result)
+        2
+        >>> result.frame_detections(1).boxes.tolist()
+        [[5, 0, 10, 10], [50, 50, 20, 10]]
+        >>> result.frame_trace_ids(1).tolist()
+        [1, 2]
+        >>> result.to_dict()["frames"][0]
+        {'detected': True, 'boxes': [[0, 0, 10, 10]], 'labels': ['car'], 'scores': [1.0], 'trace_ids': [1]}
+    """
+
+    detections: Detections
+    trace_ids: np.ndarray
+    frame_offsets: np.ndarray
+    detected: np.ndarray
+    car_counter: int
+    zone_counts: Dict[str, int] = field(default_factory=dict)
+    fps: float = 30
+
+    def __post_init__(self):
+        self.trace_ids = np.asarray(self.trace_ids, dtype=np.int64)
+        self.frame_offsets = np.asarray(self.frame_offsets, dtype=np.int64)
+        self.detected = np.asarray(self.detected, dtype=bool)
+
+    @classmethod
+    def from_frames(cls,
+                    detections_in_frames: List[Detections],
+                    trace_ids_in_frames: List[List[int]],
+                    detected: List[bool],
+                    car_counter: int,
+                    zone_counts: Dict[str, int] = None,
+                    fps: float = 30) -> "ProcessingResult":
+        """Creates the result from the cars tracked in each frame and their trace ids."""
+        detections, counts = Detections.concatenate(detections_in_frames)
+        trace_ids = np.fromiter((trace_id for trace_ids in trace_ids_in_frames for trace_id in trace_ids),
+                                dtype=np.int64, count=len(detections))
+        frame_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(detections, trace_ids, frame_offsets, detected, car_counter, dict(zone_counts or {}), fps)
+
+    def frame_detections(self, index: int) -> Detections:
+        """Returns the cars tracked in a frame."""
+        return self.detections[self.frame_offsets[index]:self.frame_offsets[index + 1]]
+
+    def frame_trace_ids(self, index: int) -> np.ndarray:
+        """Returns the ids of the traces of the cars tracked in a frame."""
+        return self.trace_ids[self.frame_offsets[index]:self.frame_offsets[index + 1]]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the result as a dict which can be serialized as JSON, with the cars of each frame."""
+        labels = np.array(self.detections.labels, dtype=object)
+        boxes = self.detections.boxes.tolist()
+        frame_labels = labels[self.detections.class_ids].tolist() if len(labels) else []
+        scores = self.detections.scores.tolist()
+        trace_ids = self.trace_ids.tolist()
+        frames = []
+        for index, (start, stop) in enumerate(zip(self.frame_offsets[:-1].tolist(), self.frame_offsets[1:].tolist())):
+            frames.append({"detected": bool(self.detected[index]),
+                           "boxes": boxes[start:stop],
+                           "labels": frame_labels[start:stop],
+                           "scores": scores[start:stop],
+                           "trace_ids": trace_ids[start:stop]})
+        return {"fps": self.fps, "car_counter": self.car_counter, "zone_counts": self.zone_counts, "frames": frames}
+
+    def save(self, path: str) -> None:
+        """Saves the result. If the path ends with ``.json``, the result is saved as JSON with the cars of each frame,
+        and otherwise as the compressed NumPy arrays of the result (``.npz``)."""
+        if path.endswith(".json"):
+            with open(path, "w") as file:
+                json.dump(self.to_dict(), file)
+            return
+
+        np.savez_compressed(path, boxes=self.detections.boxes, class_ids=self.detections.class_ids,
+                            scores=self.detections.scores, labels=np.array(self.detections.labels, dtype=str),
+                            trace_ids=self.trace_ids, frame_offsets=self.frame_offsets, detected=self.detected,
+                            car_counter=self.car_counter, fps=self.fps,
+                            zone_names=np.array(list(self.zone_counts), dtype=str),
+                            zone_counts=np.array(list(self.zone_counts.values()), dtype=np.int64))
+
+    @classmethod
+    def load(cls, path: str) -> "ProcessingResult":
+        """Loads a result saved with ``save`` in any of its formats."""
+        if path.endswith(".json"):
+            with open(path) as file:
+                content = json.load(file)
+            frames = content["frames"]
+            labels = tuple(dict.fromkeys(label for frame in frames for label in frame["labels"])) or ("car",)
+            label_ids = {label: i for i, label in enumerate(labels)}
+            detections = Detections(np.array([box for frame in frames for box in frame["boxes"]]),
+                                    [label_ids[label] for frame in frames for label in frame["labels"]],
+                                    [score for frame in frames for score in frame["scores"]],
+                                    labels)
+            return cls(detections,
+                       [trace_id for frame in frames for trace_id in frame["trace_ids"]],
+                       np.concatenate([[0], np.cumsum([len(frame["boxes"]) for frame in frames])]),
+                       [frame["detected"] for frame in frames],
+                       content["car_counter"], content["zone_counts"], content["fps"])
+
+        with np.load(path) as arrays:
+            detections = Detections(arrays["boxes"], arrays["class_ids"], arrays["scores"],
+                                    tuple(arrays["labels"].tolist()))
+            zone_counts = dict(zip(arrays["zone_names"].tolist(), arrays["zone_counts"].tolist()))
+            return cls(detections, arrays["trace_ids"], arrays["frame_offsets"], arrays["detected"],
+                       int(arrays["car_counter"]), zone_counts, float(arrays["fps"]))
+
+    def __len__(self):
+        return len(self.detected)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
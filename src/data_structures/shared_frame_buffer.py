@@ -0,0 +1,81 @@
+"""Contains the definition of the SharedFrameBuffer class"""
+from typing import Optional, Tuple
+
+from multiprocessing import shared_memory
+import numpy as np
+
+from .frame import Frame
+
+
+class SharedFrameBuffer:
+    """A ring buffer of preallocated frame slots in shared memory.
+
+    The frame with index ``i`` is stored in the slot ``i % n_slots``, so a process can write a window of consecutive
+    frames while other processes read them, without copy, by slot index. The buffer can be passed to other processes
+    as an argument (e.g. to the initializer of a ``multiprocessing.Pool``): only its name and shape are pickled and
+    the receiving process attaches to the same block of memory.
+
+    Only the process that created the buffer frees the shared memory when the buffer is closed.
+
+    Args:
+        n_slots: the number of frames the buffer can hold
+        frame_shape: the shape of the frames as (height, width, channels)
+        name: the name of an existing buffer to attach to. If None, a new block of shared memory is created.
+            Defaults to None.
+    """
+
+    def __init__(self, n_slots: int, frame_shape: Tuple[int, int, int], name: Optional[str] = None):
+        self.n_slots = n_slots
+        self.frame_shape = tuple(frame_shape)
+        self._owner = name is None
+        size = n_slots * int(np.prod(self.frame_shape))
+        self._shared_memory = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+        self.slots = np.ndarray((n_slots, *self.frame_shape), dtype=np.uint8, buffer=self._shared_memory.buf)
+
+    @property
+    def name(self) -> str:
+        return self._shared_memory.name
+
+    def slot(self, index: int) -> int:
+        """Returns the slot where the frame with the given index is stored."""
+        return index % self.n_slots
+
+    def put(self, index: int, frame: Frame) -> int:
+        """Copies the frame with the given index into its slot.
+
+        Args:
+            index: the index of the frame in the video
+            frame: the frame to copy
+
+        Returns:
+            The slot where the frame has been stored.
+        """
+        slot = self.slot(index)
+        self.slots[slot] = frame.image
+        return slot
+
+    def get(self, slot: int) -> Frame:
+        """Returns a frame which is a view of the given slot.
+
+        The frame is not copied, so it changes if the slot is overwritten.
+        """
+        return Frame(self.slots[slot])
+
+    def close(self) -> None:
+        """Detaches from the shared memory and, if this buffer created it, frees it."""
+        del self.slots
+        self._shared_memory.close()
+        if self._owner:
+            self._shared_memory.unlink()
+
+    def __reduce__(self):
+        return self.__class__, (self.n_slots, self.frame_shape, self.name)
+
+    def __enter__(self) -> "SharedFrameBuffer":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.n_slots
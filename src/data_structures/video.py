@@ -1,8 +1,13 @@
-from typing import List, Tuple, Optional
+from typing import Callable, List, Tuple, Optional, Iterable, Iterator, Sequence
+import itertools
+import os
 import time
 import cv2
 
 from .frame import Frame
+from .frame_store import FrameStore
+from .video_writer import VideoWriter
+from src.pipeline import prefetch
 
 
 class Video:
@@ -10,28 +15,68 @@ class Video:
 
     It can be created from a path to a video or from a list of frames.
 
+    When created from a path, the frames are decoded up front unless ``stream`` is set. In streaming mode only the
+    metadata of the video is read and the frames are decoded on demand each time the video is iterated, so memory is
+    bounded by the frames the consumer keeps alive rather than by the length of the video.
+
     Args:
         path: the path to the video. Defaults to "".
         frames: the frames to create the video from. Defaults to None.
         fps: the frames per second of the video. Only used if frames is not None. Defaults to 30.
+        stream: whether to decode the frames lazily instead of loading them all in memory. Only used if path is set.
+            Defaults to False.
+        start: index of the first frame of the video to use. Only used if path is set. Defaults to 0.
+        stop: index of the frame where to stop (exclusive). If None, the video is read until the end. Only used if
+            path is set. Defaults to None.
+        step: only every ``step``-th frame in the range is used. Skipped frames are grabbed but not decoded. Only used
+            if path is set. Defaults to 1.
+        frame_store: the path of a ``FrameStore`` with the decoded frames of the video. If it does not exist, or was
+            decoded from another video or from an older version of this one, the whole video is decoded into it. The
+            frames are then read from the store without decoding them, as read-only views which are only loaded when
+            used, so ``stream`` is ignored. Only used if path is set. Defaults to None.
 
     Raises:
-        ValueError: if neither path nor frames is set
+        ValueError: if neither path nor frames is set or if the frame range is not valid
     """
 
-    def __init__(self, path: str = "", frames: Optional[List[Frame]] = None, fps: int = 30):
+    def __init__(self,
+                 path: str = "",
+                 frames: Optional[List[Frame]] = None,
+                 fps: int = 30,
+                 stream: bool = False,
+                 start: int = 0,
+                 stop: Optional[int] = None,
+                 step: int = 1,
+                 frame_store: Optional[str] = None):
+        if start < 0 or step < 1 or (stop is not None and stop < start):
+            raise ValueError(f"Invalid frame range: start={start}, stop={stop}, step={step}.")
+
         self.path = path
-        if path:
+        self.stream = False
+        self.start = 0
+        self.stop = None
+        self.step = 1
+        if path and frame_store is not None:
+            self.start, self.stop, self.step = start, stop, step
+            self._set_frames_from_store(frame_store)
+        elif path:
             self.video_capture: cv2.VideoCapture = cv2.VideoCapture(path)
             self.fps = self.video_capture.get(cv2.CAP_PROP_FPS)
-            self.frames: List[Frame] = None
+            self.frames: Optional[Sequence[Frame]] = None
             self.frame_width = int(self.video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
             self.frame_height = int(self.video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self._set_frames()
+            self.frame_count = int(self.video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            self.stream = stream
+            self.start, self.stop, self.step = start, stop, step
+            if stream:
+                self.video_capture.release()
+            else:
+                self._set_frames()
         elif frames is not None:  # Create video from list of frames
             self.video_capture = None
             self.fps = fps
             self.frames = frames
+            self.frame_count = len(frames)
             frame_0 = frames[0]
             self.frame_height = frame_0.height
             self.frame_width = frame_0.width
@@ -47,22 +92,99 @@ class Video:
 
         It is called when the video is created from a path.
         """
-        self.frames = []
-        while self.video_capture.isOpened():
-            ret, frame = self.video_capture.read()
-            if not ret:
+        try:
+            self.frames = list(self._read_frames(self.video_capture, self.start, self.stop, self.step))
+        finally:
+            self.video_capture.release()
+
+    def _set_frames_from_store(self, store_path: str) -> None:
+        """Sets the frames of the video from the frame store, which is created first if it is not a store of the
+        video."""
+        store = None
+        if os.path.exists(store_path):
+            try:
+                store = FrameStore(store_path)
+            except ValueError:
+                store = None
+        if store is None or not store.is_store_of(self.path):
+            video_capture = cv2.VideoCapture(self.path)
+            try:
+                store = FrameStore.create(store_path, self._read_frames(video_capture),
+                                          video_capture.get(cv2.CAP_PROP_FPS), self.path)
+            finally:
+                video_capture.release()
+
+        self.video_capture = None
+        self.fps = store.fps
+        self.frame_width, self.frame_height = store.size
+        self.frame_count = len(store)
+        self.frames = store[self.start:self.stop:self.step]
+
+    @staticmethod
+    def _read_frames(video_capture: cv2.VideoCapture,
+                     start: int = 0,
+                     stop: Optional[int] = None,
+                     step: int = 1) -> Iterator[Frame]:
+        """Reads the frames in ``range(start, stop, step)`` from an opened video capture.
+
+        Args:
+            video_capture: the video capture to read from
+            start: index of the first frame to read
+            stop: index of the frame where to stop (exclusive). If None, the capture is read until the end.
+            step: only every ``step``-th frame is decoded. The frames in between are grabbed and discarded.
+        """
+        if start:
+            video_capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while video_capture.isOpened() and (stop is None or index < stop):
+            if (index - start) % step == 0:
+                ret, image = video_capture.read()
+                if not ret:
+                    break
+                yield Frame(image)
+            elif not video_capture.grab():
                 break
-            self.frames.append(Frame(frame))
+            index += 1
+
+    def iter_frames(self, prefetch_size: int = 0, on_get: Optional[Callable[[int], None]] = None) -> Iterator[Frame]:
+        """Yields the frames of the video.
+
+        In streaming mode a new capture is opened for every call, so the video can be iterated several times and
+        from several threads or processes at once.
 
-        self.video_capture.release()
+        Args:
+            prefetch_size: if positive, the frames are decoded in a background thread which stays at most this many
+                frames ahead of the consumer. Only used in streaming mode. Defaults to 0.
+            on_get: a function called with the number of decoded frames waiting before each frame is taken. Only used
+                if the frames are prefetched. Defaults to None.
+        """
+        if self.frames is not None:
+            yield from self.frames
+        elif prefetch_size > 0:
+            yield from prefetch(self._decode_frames(), prefetch_size, on_get)
+        else:
+            yield from self._decode_frames()
 
-    def save(self, path: str) -> None:
-        """Saves the video to the given path."""
-        self.create_video(self.frames, path, self.fps, self.size)
+    def _decode_frames(self) -> Iterator[Frame]:
+        video_capture = cv2.VideoCapture(self.path)
+        try:
+            yield from self._read_frames(video_capture, self.start, self.stop, self.step)
+        finally:
+            video_capture.release()
+
+    def save(self, path: str, codec: Optional[str] = None) -> None:
+        """Saves the video to the given path.
+
+        Args:
+            path: the path to save the video. Its extension determines the container.
+            codec: the four character code of the codec. If None, a codec suitable for the container is chosen.
+                Defaults to None.
+        """
+        self.create_video(self, path, self.fps, self.size, codec)
 
     def visualize(self) -> None:
         """Visualizes the video."""
-        for frame in self.frames:
+        for frame in self:
             time.sleep((1/self.fps) - 0.021)
             cv2.imshow("frame", frame.image)
             if cv2.waitKey(1) & 0xFF == ord("x") or cv2.getWindowProperty("frame", cv2.WND_PROP_VISIBLE) < 1:
@@ -70,27 +192,59 @@ class Video:
         cv2.destroyAllWindows()
 
     @staticmethod
-    def create_video(frames: List[Frame], path: str, fps: int, size: Tuple[int, int] = None) -> None:
+    def create_video(frames: Iterable[Frame],
+                     path: str,
+                     fps: int,
+                     size: Tuple[int, int] = None,
+                     codec: Optional[str] = None,
+                     queue_size: int = 8) -> None:
         """Creates a video from the frames.
 
+        The frames are encoded in a background thread while the next ones are produced.
+
         Args:
-            frames: the frames to create the video from
-            path: the path to save the video
+            frames: the frames to create the video from. It can be any iterable, e.g. a generator, in which case the
+                frames are written as they are produced.
+            path: the path to save the video. Its extension determines the container.
             fps: the frames per second of the video
             size: the size of the video. Defaults to None.
+            codec: the four character code of the codec. If None, a codec suitable for the container is chosen.
+                Defaults to None.
+            queue_size: the maximum number of frames waiting to be encoded. Defaults to 8.
         """
-        size = size if size is not None else (frames[0].width, frames[0].height)
-        fourcc = cv2.VideoWriter_fourcc(*"MJPG")
-        out = cv2.VideoWriter(path, fourcc, fps, size)
-        for frame in frames:
-            out.write(frame.image)
-        out.release()
+        if size is None:
+            frames = iter(frames)
+            frame_0 = next(frames)
+            size = (frame_0.width, frame_0.height)
+            frames = itertools.chain([frame_0], frames)
+        with VideoWriter(path, fps, size, codec, queue_size) as writer:
+            for frame in frames:
+                writer.write(frame)
 
     def __iter__(self):
-        return iter(self.frames)
+        return self.iter_frames()
 
     def __getitem__(self, item: int) -> Frame:
-        return self.frames[item]
+        if self.frames is not None:
+            return self.frames[item]
+
+        length = len(self)
+        index = item + length if item < 0 else item
+        if not 0 <= index < length:
+            raise IndexError("Video index out of range")
+        index = self.start + index * self.step
+        video_capture = cv2.VideoCapture(self.path)
+        try:
+            frame = next(self._read_frames(video_capture, index, index + 1), None)
+        finally:
+            video_capture.release()
+        if frame is None:
+            raise IndexError(f"Could not read frame {index} of {self.path}")
+        return frame
 
     def __len__(self):
-        return len(self.frames)
+        if self.frames is not None:
+            return len(self.frames)
+
+        stop = self.frame_count if self.stop is None else min(self.stop, self.frame_count)
+        return max(0, -(-(stop - self.start) // self.step))
@@ -0,0 +1,94 @@
+"""Contains the definition of the VideoWriter class"""
+from typing import Optional, Tuple
+
+import os
+import queue
+import threading
+
+import cv2
+
+from .frame import Frame
+
+
+class VideoWriter:
+    """Writes frames to a video file, encoding them in a background thread.
+
+    The frames are put in a bounded queue and encoded while the caller goes on producing the next ones. Since OpenCV
+    releases the GIL while encoding, both overlap. The frames must not be modified after being written.
+
+    Args:
+        path: the path of the video. Its extension determines the container.
+        fps: the frames per second of the video
+        size: the size of the video as (width, height)
+        codec: the four character code of the codec. If None, a codec suitable for the container is chosen.
+            Defaults to None.
+        queue_size: the maximum number of frames waiting to be encoded. If 0, frames are encoded synchronously.
+            Defaults to 8.
+
+    Raises:
+        ValueError: if the video cannot be opened for writing
+    """
+
+    CODECS = {".avi": "MJPG", ".mp4": "mp4v", ".mov": "mp4v", ".mkv": "XVID"}
+    DEFAULT_CODEC = "MJPG"
+
+    def __init__(self, path: str, fps: float, size: Tuple[int, int], codec: Optional[str] = None,
+                 queue_size: int = 8):
+        extension = os.path.splitext(path)[1].lower()
+        self.codec = codec if codec is not None else self.CODECS.get(extension, self.DEFAULT_CODEC)
+        self.path = path
+        self._writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.codec), fps, size)
+        if not self._writer.isOpened():
+            raise ValueError(f"Could not open {path} for writing with codec {self.codec}.")
+
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        if queue_size > 0:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._encode, daemon=True)
+            self._thread.start()
+
+    def _encode(self) -> None:
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            if self._error is None:
+                try:
+                    self._writer.write(frame.image)
+                except BaseException as exception:
+                    self._error = exception
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    @property
+    def pending(self) -> int:
+        """The number of frames waiting to be encoded."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def write(self, frame: Frame) -> None:
+        """Writes the frame, waiting if too many frames are waiting to be encoded."""
+        self._raise_error()
+        if self._queue is None:
+            self._writer.write(frame.image)
+        else:
+            self._queue.put(frame)
+
+    def close(self) -> None:
+        """Waits for the frames that are waiting to be encoded and closes the video."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._writer.release()
+        self._raise_error()
+
+    def __enter__(self) -> "VideoWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
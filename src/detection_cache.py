@@ -0,0 +1,144 @@
+"""Persistent cache of the detections of the frames of videos."""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from src.car_detectors.car_detector import CarDetector
+from src.data_structures import Detections, Video
+
+
+class DetectionCache:
+    """Stores the detections of every frame of a video on disk, so that the video can be tracked again, e.g. with
+    other tracker parameters or action zone, without running the car detector.
+
+    The detections of a video are stored concatenated in a few ``.npy`` arrays, together with the offset of the
+    detections of each frame, and are read back memory-mapped. An entry is identified by the hash of the content of
+    the video file, the frame range used, and the class and ``config`` of the car detector.
+
+    When the entries take more than ``max_bytes``, the least recently used ones are deleted.
+
+    Args:
+        directory: the directory where the entries are stored. It is created if it does not exist.
+        max_bytes: the maximum size of the entries. Defaults to 1 GiB.
+    """
+
+    _HASHES_FILE = "video_hashes.json"
+
+    def __init__(self, directory: str, max_bytes: int = 2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _hash_video(self, path: str) -> str:
+        """Returns the hash of the content of a video file.
+
+        The hashes are remembered by path, size and modification time, so each file is only read once.
+        """
+        stat = os.stat(path)
+        file_id = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        hashes_path = os.path.join(self.directory, self._HASHES_FILE)
+        hashes: Dict[str, str] = {}
+        if os.path.exists(hashes_path):
+            with open(hashes_path) as file:
+                hashes = json.load(file)
+        if file_id not in hashes:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(2 ** 20), b""):
+                    digest.update(block)
+            hashes[file_id] = digest.hexdigest()
+            self._write_atomically(hashes_path, lambda file: file.write(json.dumps(hashes).encode()))
+        return hashes[file_id]
+
+    def _write_atomically(self, path: str, write) -> None:
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, "wb") as file:
+            write(file)
+        os.replace(temporary_path, path)
+
+    def key(self, video: Video, car_detector: CarDetector) -> str:
+        """Returns the key of the detections of the car detector in the video.
+
+        Raises:
+            ValueError: if the video was not read from a file
+        """
+        if not video.path:
+            raise ValueError("Only the detections of videos read from a file can be cached.")
+        detector_class = type(car_detector)
+        description = {
+            "video": self._hash_video(video.path),
+            "range": [video.start, video.stop, video.step],
+            "detector": f"{detector_class.__module__}.{detector_class.__qualname__}",
+            "config": car_detector.config(),
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def load(self, key: str) -> Optional[List[Detections]]:
+        """Returns the detections of each frame stored with the key, or None if there are none.
+
+        The arrays of the detections are read-only views of the memory-mapped files.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            offsets = np.load(os.path.join(entry_path, "offsets.npy"))
+            boxes, class_ids, scores = (np.load(os.path.join(entry_path, f"{name}.npy"), mmap_mode="r")
+                                        for name in ("boxes", "class_ids", "scores"))
+            with open(os.path.join(entry_path, "labels.json")) as file:
+                labels = tuple(json.load(file))
+        except FileNotFoundError:
+            return None
+
+        # The modification time of an entry is its last use
+        os.utime(entry_path)
+        return [Detections(boxes[start:stop], class_ids[start:stop], scores[start:stop], labels)
+                for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+    def store(self, key: str, detections_in_video: Sequence[Detections]) -> None:
+        """Stores the detections of each frame of a video with the key, and evicts old entries if needed."""
+        detections, counts = Detections.concatenate(detections_in_video)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        # The entry is written in a temporary directory and renamed, so it is never seen partially written
+        temporary_path = tempfile.mkdtemp(dir=self.directory)
+        for name, array in (("boxes", detections.boxes), ("class_ids", detections.class_ids),
+                            ("scores", detections.scores), ("offsets", offsets)):
+            np.save(os.path.join(temporary_path, f"{name}.npy"), array)
+        with open(os.path.join(temporary_path, "labels.json"), "w") as file:
+            json.dump(detections.labels, file)
+        try:
+            os.rename(temporary_path, self._entry_path(key))
+        except OSError:  # Stored meanwhile by other process
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        self.evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """Returns the (last use, size, path) of each entry."""
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_path = os.path.join(self.directory, name)
+            if os.path.isdir(entry_path):
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+        return entries
+
+    def evict(self) -> None:
+        """Deletes the least recently used entries until the entries take at most ``max_bytes``."""
+        entries = sorted(self._entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
+
+    def clear(self) -> None:
+        """Deletes all the entries."""
+        for _, _, entry_path in self._entries():
+            shutil.rmtree(entry_path, ignore_errors=True)
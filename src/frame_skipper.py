@@ -0,0 +1,69 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from src.data_structures import Frame
+
+
+class FrameSkipper:
+    """Decides in which frames of a video the car detector runs.
+
+    Consecutive frames of a video barely differ, so detection can run only every few frames, or only when the
+    frame has changed enough since the last frame where it ran. In the skipped frames the tracker predicts where
+    the cars are.
+
+    Stateful detectors like ``ClassicDetector`` compare each frame with the last frame they have seen, which is
+    the last frame where detection ran. The speed of a new car is not known until it has been detected twice, so
+    the tracker multiplies its tolerance by the number of frames since each car was detected. On the sample video,
+    the count is the same with the default parameters as without skipping frames.
+
+    Args:
+        detect_every: the maximum number of frames between two detections. Defaults to 3.
+        motion_threshold: if set, detection also runs in every frame whose motion score is above it. The motion
+            score is the mean absolute difference, in gray levels, between small grayscale copies of the frame and
+            of the last frame where detection ran. Defaults to None.
+        thumbnail_width: the width of the copies of the frames used to compute the motion score. Defaults to 64.
+    """
+
+    def __init__(self, detect_every: int = 3, motion_threshold: Optional[float] = None, thumbnail_width: int = 64):
+        if detect_every < 1:
+            raise ValueError(f"detect_every must be at least 1, got {detect_every}.")
+        self.detect_every = detect_every
+        self.motion_threshold = motion_threshold
+        self.thumbnail_width = thumbnail_width
+        self._last_thumbnail: Optional[np.ndarray] = None
+        self._frames_since_detection: Optional[int] = None
+
+    def reset(self) -> None:
+        """Forgets the frames seen, so detection runs in the next frame."""
+        self._last_thumbnail = None
+        self._frames_since_detection = None
+
+    def _thumbnail(self, frame: Frame) -> np.ndarray:
+        height = max(1, round(frame.height * self.thumbnail_width / frame.width))
+        thumbnail = cv2.resize(frame.image, (self.thumbnail_width, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+
+    def should_detect(self, frame: Frame) -> bool:
+        """Returns whether the car detector has to run in the frame. It must be called with every frame, in order.
+
+        Args:
+            frame: the next frame of the video
+        """
+        if self._frames_since_detection is None:
+            detect = True
+        else:
+            self._frames_since_detection += 1
+            detect = self._frames_since_detection >= self.detect_every
+
+        thumbnail = None
+        if self.motion_threshold is not None:
+            thumbnail = self._thumbnail(frame)
+            if not detect:
+                detect = float(cv2.absdiff(thumbnail, self._last_thumbnail).mean()) > self.motion_threshold
+
+        if detect:
+            self._frames_since_detection = 0
+            self._last_thumbnail = thumbnail
+        return detect
@@ -0,0 +1,79 @@
+"""Helpers to run the stages of a processing pipeline concurrently"""
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+import queue
+import threading
+
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class _ProducerError:
+    """Wraps an exception raised by a producer so that it can be re-raised by the consumer."""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def prefetch(iterable: Iterable[T], maxsize: int = 4, on_get: Optional[Callable[[int], None]] = None) -> Iterator[T]:
+    """Consumes an iterable in a background thread and yields its items through a bounded queue.
+
+    The producer never runs more than ``maxsize`` items ahead of the consumer, so chaining several stages with this
+    function keeps the memory used by the pipeline bounded by a handful of items. Since OpenCV and NumPy release the
+    GIL in their heavy calls, the stages actually overlap.
+
+    Exceptions raised by the producer are re-raised in the consumer. If the consumer stops early, the producer is
+    stopped as soon as it produces its next item.
+
+    Args:
+        iterable: the iterable to consume in the background
+        maxsize: the maximum number of items waiting in the queue. Defaults to 4.
+        on_get: a function called with the number of items waiting in the queue before each item is taken, e.g. to
+            monitor whether the producer or the consumer is the bottleneck. Defaults to None.
+
+    Yields:
+        The items of the iterable, in order.
+    """
+    items = queue.Queue(maxsize=max(1, maxsize))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    break
+        except BaseException as exception:
+            put(_ProducerError(exception))
+        else:
+            put(_DONE)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            if on_get is not None:
+                on_get(items.qsize())
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
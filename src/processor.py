@@ -1,11 +1,105 @@
-from typing import Tuple, Optional, List, Union
+from typing import Dict, Tuple, Optional, List, Union, Iterable, Iterator, Sequence
 
 from copy import deepcopy
 import multiprocessing
+import pickle
+import numpy as np
 
 from src.car_detectors.car_detector import CarDetector
-from src.data_structures import Video, Rectangle, Frame
+from src.data_structures import (Video, VideoWriter, Rectangle, Frame, FrameStore, Detections, SharedFrameBuffer,
+                                 ProcessingResult)
+from src.detection_cache import DetectionCache
+from src.frame_skipper import FrameSkipper
+from src.profiling import ProfileEvent, Profiler
 from src.tracker import Tracker
+from src.zones import CountLine, Zone, ZoneCounter
+
+
+SHARED_MEMORY_SLOTS_PER_JOB = 8
+
+# State of the workers of the shared memory pool, set by _init_shared_memory_worker
+_worker_car_detector: Optional[CarDetector] = None
+_worker_frame_buffer: Optional[SharedFrameBuffer] = None
+
+
+def _init_shared_memory_worker(car_detector: CarDetector, frame_buffer: SharedFrameBuffer):
+    global _worker_car_detector, _worker_frame_buffer
+    _worker_car_detector = car_detector
+    _worker_frame_buffer = frame_buffer
+
+
+def _detect_pickled_chunk(task: Tuple[CarDetector, bytes]) -> Tuple[List[Detections], List[ProfileEvent]]:
+    """Detects cars in a chunk of frames pickled together with its context frames, recording the stages of the
+    worker.
+
+    Returns:
+        The detections of each frame, and the events recorded by the worker.
+    """
+    car_detector, chunk = task
+    # The profiler of the main process is disabled when it is pickled, so the worker records into its own
+    car_detector.profiler = Profiler()
+    with car_detector.profiler.stage("deserialize"):
+        frames, context = pickle.loads(chunk)
+    return car_detector.detect_chunk(frames, context), car_detector.profiler.events
+
+
+def _detect_shared_memory_chunk(slots: List[int], context_slots: List[int],
+                                profile: bool) -> Tuple[Detections, np.ndarray, List[ProfileEvent]]:
+    """Detects cars in a chunk of frames stored in the shared frame buffer of the worker.
+
+    Returns:
+        The detections of the chunk concatenated, which are much cheaper to pickle than one object per frame, the
+        number of detections of each frame, and the events recorded by the worker if it is profiled.
+    """
+    _worker_car_detector.profiler = Profiler(enabled=profile)
+    frames = [_worker_frame_buffer.get(slot) for slot in slots]
+    context = [_worker_frame_buffer.get(slot) for slot in context_slots]
+    detections_in_chunk = _worker_car_detector.detect_chunk(frames, context)
+    detections, counts = Detections.concatenate([Detections.from_rectangles(detections)
+                                                 for detections in detections_in_chunk])
+    return detections, counts, _worker_car_detector.profiler.events
+
+
+class _TraceOverlay:
+    """Draws the traces of the cars incrementally.
+
+    The centers of the rectangles of each trace are kept in an array which is only extended with the new rectangles
+    of each frame, and all the traces are drawn with a single call, so the Python work per frame does not depend on
+    the length of the traces.
+    """
+
+    def __init__(self):
+        self._points: Dict[int, np.ndarray] = {}
+        self._lengths: Dict[int, int] = {}
+
+    def _update(self, trace_id: int, trace: List[Rectangle], n_replaced: int) -> np.ndarray:
+        """Returns the centers of the trace, computing only the ones of the rectangles added or replaced since the
+        last frame."""
+        points = self._points.get(trace_id)
+        n_valid = max(0, min(self._lengths.get(trace_id, 0), len(trace)) - n_replaced)
+        if points is None or len(points) < len(trace):
+            new_points = np.empty((max(16, 2 * len(trace)), 2), dtype=np.int32)
+            if points is not None:
+                new_points[:n_valid] = points[:n_valid]
+            points = self._points[trace_id] = new_points
+        if n_valid < len(trace):
+            points[n_valid:len(trace)] = [rectangle.center for rectangle in trace[n_valid:]]
+        self._lengths[trace_id] = len(trace)
+        return points[:len(trace)]
+
+    def draw(self, frame: Frame, traces: Dict[int, List[Rectangle]], n_replaced: int = 0) -> None:
+        """Draws the traces on the frame.
+
+        Args:
+            frame: the frame to draw on
+            traces: the active traces by id. The arrays of the other traces are dropped.
+            n_replaced: the number of rectangles at the end of the traces which may have changed since the last
+                frame, e.g. predicted rectangles replaced by interpolated ones. Defaults to 0.
+        """
+        polylines = [self._update(trace_id, trace, n_replaced) for trace_id, trace in traces.items()]
+        for trace_id in self._points.keys() - traces.keys():
+            del self._points[trace_id], self._lengths[trace_id]
+        frame.draw_polylines([points for points in polylines if len(points) > 1], color=(0, 0, 255))
 
 
 class Processor:
@@ -13,30 +107,67 @@ class Processor:
 
     Args:
         car_detector: the car detector to use
+        video_path: the path to the video to process. It can be None when the frames come from somewhere else,
+            e.g. a live source, and are processed with ``process_frame``, in which case frame_size must be given.
         action_zone: the action zone to use. If not specified, the whole frame is used. If specified, it must be a
             tuple of 4 integers, where the first two integers are the top left corner of the action zone, and the
             last two integers are the width and height of the action zone. These two last integers can be set to None
             to use the whole width or height of the frame until the right or bottom border of the frame.
+        tracker: the tracker to use. Defaults to a ``Tracker`` with its default parameters.
+        stream: whether to decode the frames of the video lazily instead of loading the whole video in memory.
+            Defaults to False.
+        zones: zones and count lines where the cars tracked in the action zone are counted separately, each trace
+            at most once per zone. A car is in a zone when its center is. Their names must be different. Defaults
+            to None.
+        frame_skipper: decides in which frames the car detector runs. In the other frames the position of the cars
+            is predicted by the tracker. If None, the car detector runs in every frame. Defaults to None.
+        frame_size: the size of the frames as (width, height). Only used if video_path is None. Defaults to None.
+        detection_cache: where to store the detections of the video, so that processing the video again with the
+            same car detector does not run it. It is not used with a frame skipper. Defaults to None.
+        profiler: where to record the duration of each stage of the processing of each frame (reading, detection,
+            filtering, tracking, drawing, writing...) and, once per frame, the number of detections, cars and active
+            traces and the depth of the queues between stages. It is also set as the profiler of the car detector,
+            which records its own stages. If None, nothing is recorded. Defaults to None.
+        frame_store: the path of a ``FrameStore`` where the video is decoded the first time, so that processing it
+            again only reads its pixels. If set, ``stream`` is ignored. Defaults to None.
+
+    Raises:
+        ValueError: if neither video_path nor frame_size is set
     """
 
     def __init__(self,
                  car_detector: CarDetector,
-                 video_path: str,
+                 video_path: Optional[str] = None,
                  action_zone: Optional[Union[Tuple[int, int, Optional[int], Optional[int]], Rectangle]] = None,
-                 tracker: Optional[Tracker] = None):
+                 tracker: Optional[Tracker] = None,
+                 stream: bool = False,
+                 zones: Optional[Sequence[Union[Zone, CountLine]]] = None,
+                 frame_skipper: Optional[FrameSkipper] = None,
+                 frame_size: Optional[Tuple[int, int]] = None,
+                 detection_cache: Optional[DetectionCache] = None,
+                 profiler: Optional[Profiler] = None,
+                 frame_store: Optional[str] = None):
+        if video_path is None and frame_size is None:
+            raise ValueError("Either video_path or frame_size must be set.")
         self.car_detector = car_detector
-        self.video = Video(video_path)
+        self.video = (Video(video_path, stream=stream, frame_store=frame_store) if video_path is not None
+                      else None)
+        self.frame_size = self.video.size if self.video is not None else tuple(frame_size)
         self.action_zone = action_zone
-
-        if self.action_zone is None:
-            self.action_zone = Rectangle(0, 125, self.video.frame_width, self.video.frame_height - 125)
-        if isinstance(self.action_zone, tuple):
-            x, y, w, h = self.action_zone
-            w = w if w is not None else self.video.frame_width - x
-            h = h if h is not None else self.video.frame_height - y
-            self.action_zone = Rectangle(x, y, w, h)
+        self._set_action_zone(self.frame_size)
 
         self.tracker = Tracker() if tracker is None else tracker
+        self.zone_counter = ZoneCounter(zones, self.frame_size, self.tracker.min_trace_length) if zones else None
+        self.frame_skipper = frame_skipper
+        self.detection_cache = detection_cache
+        self.profiler = Profiler(enabled=False) if profiler is None else profiler
+        if profiler is not None:
+            car_detector.profiler = profiler
+        self._trace_overlay = _TraceOverlay()
+        # Number of frames since the car detector last ran, whose predicted rectangles are replaced when it runs, and
+        # number of rectangles at the end of the traces which may have been replaced in the current frame
+        self._n_skipped_frames = 0
+        self._n_replaced = 0
 
     def _set_action_zone(self, video_dim: Tuple[int, int]):
         if self.action_zone is None:
@@ -47,39 +178,392 @@ class Processor:
             h = h if h is not None else video_dim[1] - y
             self.action_zone = Rectangle(x, y, w, h)
 
-    def _draw_scene(self, frame: Frame, cars_in_action_zone: List[Rectangle], traces: List[List[Rectangle]]):
+    def _draw_scene(self, frame: Frame, cars_in_action_zone: Detections, traces: Dict[int, List[Rectangle]]):
         frame.draw_rectangles([car_in_action_zone for car_in_action_zone in cars_in_action_zone
                                if "car" in car_in_action_zone.label], draw_labels=True)
         frame.draw_rectangle(self.action_zone, color=(0, 255, 0))
         frame.draw_text(f"Car counter: {self.tracker.car_counter}", (70, 20))
+        if self.zone_counter is not None:
+            counts = self.zone_counter.counts
+            for zone in self.zone_counter.zones:
+                frame.draw_polygon(zone.polygon, color=(0, 255, 255), closed=isinstance(zone, Zone))
+                frame.draw_text(f"{zone.name}: {counts[zone.name]}", zone.polygon[0], color=(0, 255, 255), thickness=1)
 
-        for trace in traces:
-            points = [rectangle.center for rectangle in trace]
-            for i, point in enumerate(points):
-                if i == 0:
-                    continue
-                frame.draw_line(points[i - 1], point, color=(0, 0, 255))
+        self._trace_overlay.draw(frame, traces, self._n_replaced)
+
+    def _track(self, detections: Optional[Union[Detections, List[Rectangle]]]) -> Detections:
+        """Filters the detections of a frame to the cars in the action zone and tracks them.
+
+        Args:
+            detections: the detections of the frame, or None if detection was skipped in it, in which case the cars
+                are predicted by the tracker.
+
+        Returns:
+            The tracked cars, whose trace ids are in ``tracker.last_trace_ids``.
+        """
+        if detections is None:
+            self._n_skipped_frames += 1
+            self._n_replaced = 0
+            with self.profiler.stage("track"):
+                traces = self.tracker.predict_cars()
+            cars = Detections.from_rectangles(trace[-1] for trace in traces)
+            self._count_in_zones(cars)
+            self.profiler.count("active_traces", len(traces))
+            return cars
+
+        self._n_replaced = self._n_skipped_frames
+        self._n_skipped_frames = 0
+        with self.profiler.stage("filter"):
+            detections = Detections.from_rectangles(detections)
+            is_car = detections.with_label("car")
+            cars = detections[detections.inside(self.action_zone) & is_car]
+        with self.profiler.stage("track"):
+            self.tracker.track_cars(cars)
+        self._count_in_zones(cars)
+        self.profiler.count("detections", len(detections))
+        self.profiler.count("cars", len(cars))
+        self.profiler.count("active_traces", len(self.tracker.last_trace_ids))
+        return cars
+
+    def _count_in_zones(self, cars: Detections) -> None:
+        """Counts the cars just tracked in the zones, if any."""
+        if self.zone_counter is not None:
+            with self.profiler.stage("zones"):
+                self.zone_counter.update(cars, self.tracker.last_trace_ids)
+
+    def _process_frame(self, frame: Frame, detections: Optional[Union[Detections, List[Rectangle]]]) -> None:
+        """Filters the detections of a frame to the cars in the action zone, tracks them and draws the scene.
+
+        Args:
+            frame: the frame to draw on. It is modified in place.
+            detections: the detections of the frame, or None if detection was skipped in it, in which case the cars
+                are predicted by the tracker.
+        """
+        cars = self._track(detections)
+        with self.profiler.stage("draw"):
+            traces = {trace_id: self.tracker.traces[trace_id] for trace_id in self.tracker.last_trace_ids}
+            self._draw_scene(frame, cars, traces)
+
+    def _split_in_chunks(self, start: int, stop: int, n_chunks: int) -> List[Tuple[range, range]]:
+        """Splits the frame indices in ``[start, stop)`` into contiguous chunks that can be processed independently
+        by the car detector.
+
+        Each chunk is returned together with its context: the indices of the ``context_frames`` frames preceding it,
+        which the car detector needs to restore its state.
+
+        Args:
+            start: the index of the first frame
+            stop: the index where to stop (exclusive)
+            n_chunks: the number of chunks to split the frames into
+
+        Returns:
+            A list of (chunk, context) tuples of ranges of frame indices, in order.
+        """
+        chunk_size = max(1, -(-(stop - start) // n_chunks))
+        context_frames = self.car_detector.context_frames
+        return [(range(chunk_start, min(chunk_start + chunk_size, stop)),
+                 range(max(0, chunk_start - context_frames), chunk_start))
+                for chunk_start in range(start, stop, chunk_size)]
+
+    def _detect_with_pool(self, frames: Sequence[Frame], n_jobs: int) -> List[Detections]:
+        """Detects cars in the frames using a pool of processes, pickling the frames sent to the workers. The slices
+        of a ``FrameStore`` are pickled as its path and a range of frames, so each worker maps its own frames.
+
+        When the processor is profiled, each chunk is pickled by the thread of the pool which hands the tasks to the
+        workers, just before it is sent, so that the time spent pickling it is recorded apart from the time spent
+        waiting for the workers, whose stages are merged into the profiler.
+        """
+        # Several chunks per job so that the load is balanced between workers
+        chunks = [(frames[chunk.start:chunk.stop], frames[context.start:context.stop])
+                  for chunk, context in self._split_in_chunks(0, len(frames), n_jobs * 4)]
+        if not self.profiler.enabled:
+            with multiprocessing.Pool(n_jobs) as pool:
+                detections_in_chunks = pool.starmap(self.car_detector.detect_chunk, chunks)
+            return [detections for chunk in detections_in_chunks for detections in chunk]
+
+        def pickled_chunks() -> Iterator[Tuple[CarDetector, bytes]]:
+            for chunk in chunks:
+                with self.profiler.stage("serialize"):
+                    pickled_chunk = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+                yield self.car_detector, pickled_chunk
+
+        detections_in_video = []
+        with multiprocessing.Pool(n_jobs) as pool:
+            with self.profiler.stage("wait_workers"):
+                results = list(pool.imap(_detect_pickled_chunk, pickled_chunks()))
+        for detections_in_chunk, events in results:
+            detections_in_video.extend(detections_in_chunk)
+            self.profiler.merge(events)
+        return detections_in_video
+
+    def _detect_with_shared_memory(self, frames: List[Frame], n_jobs: int) -> List[Detections]:
+        """Detects cars in the frames using a pool of processes which read the frames from shared memory.
+
+        The frames are copied, a window at a time, into a ring buffer of frame slots shared with the workers. Only
+        slot indices are sent to the workers, and the detections of each chunk are sent back concatenated.
+        """
+        if not frames:
+            return []
+        context_frames = self.car_detector.context_frames
+        n_slots = n_jobs * SHARED_MEMORY_SLOTS_PER_JOB + context_frames
+        # The context of the first chunk of a window is at the end of the previous window, so it must not be
+        # overwritten by the window
+        window = n_slots - context_frames
+        frame_shape = frames[0].image.shape
+        detections_in_video = []
+        with SharedFrameBuffer(n_slots, frame_shape) as frame_buffer, \
+                multiprocessing.Pool(n_jobs, initializer=_init_shared_memory_worker,
+                                     initargs=(self.car_detector, frame_buffer)) as pool:
+            for start in range(0, len(frames), window):
+                stop = min(start + window, len(frames))
+                with self.profiler.stage("copy_to_shared_memory"):
+                    for index in range(start, stop):
+                        frame_buffer.put(index, frames[index])
+                tasks = [([frame_buffer.slot(i) for i in chunk], [frame_buffer.slot(i) for i in context],
+                          self.profiler.enabled)
+                         for chunk, context in self._split_in_chunks(start, stop, n_jobs)]
+                with self.profiler.stage("wait_workers"):
+                    detections_in_chunks = pool.starmap(_detect_shared_memory_chunk, tasks)
+                for detections_in_chunk, counts, events in detections_in_chunks:
+                    detections_in_video.extend(detections_in_chunk.split(counts))
+                    self.profiler.merge(events)
+        return detections_in_video
 
-    def process_video(self, n_jobs: int = 1) -> Video:
+    def process_frame(self, frame: Frame) -> Frame:
+        """Detects, tracks and draws the cars of the next frame, e.g. of a live source. The frames must be given in
+        order.
+
+        Args:
+            frame: the frame to process. It is modified in place.
+
+        Returns:
+            The processed frame.
+        """
+        detect = self.frame_skipper is None or self.frame_skipper.should_detect(frame)
+        detections = None
+        if detect:
+            with self.profiler.stage("detect"):
+                detections = self.car_detector.detect_frame(frame)
+        self._process_frame(frame, detections)
+        return frame
+
+    def _select_frames(self, frames: Iterable[Frame]) -> Iterator[Tuple[Frame, bool]]:
+        """Yields each frame together with whether the car detector has to run in it."""
+        for frame in frames:
+            yield frame, self.frame_skipper is None or self.frame_skipper.should_detect(frame)
+
+    def _detect_stream(self, frames: Iterable[Frame]) -> Iterator[Tuple[Frame, Optional[Detections]]]:
+        """Detects cars in a stream of frames, skipping the frames selected by the frame skipper.
+
+        The frames where detection runs are passed to the car detector in batches of its batch size, so the frames
+        skipped in between are held back until the batch is complete.
+
+        Yields:
+            Each frame with its detections, or with None if detection is skipped in it, in order.
+        """
+        if self.frame_skipper is None:
+            yield from self.car_detector.detect_stream(frames)
+            return
+
+        pending_frames: List[Tuple[Frame, bool]] = []
+        n_selected = 0
+        for frame, detect in self._select_frames(frames):
+            pending_frames.append((frame, detect))
+            n_selected += detect
+            if n_selected >= self.car_detector.batch_size:
+                yield from self._detect_pending(pending_frames)
+                pending_frames, n_selected = [], 0
+        yield from self._detect_pending(pending_frames)
+
+    def _detect_pending(self,
+                        pending_frames: List[Tuple[Frame, bool]]) -> Iterator[Tuple[Frame, Optional[Detections]]]:
+        with self.profiler.stage("detect"):
+            detections = iter(self.car_detector.detect_batch([frame for frame, detect in pending_frames if detect]))
+        for frame, detect in pending_frames:
+            yield frame, next(detections) if detect else None
+
+    def _detection_cache_key(self) -> Optional[str]:
+        """Returns the key of the detections of the video in the detection cache, or None if it is not used."""
+        if self.detection_cache is None or self.frame_skipper is not None:
+            return None
+        return self.detection_cache.key(self.video, self.car_detector)
+
+    def _detect_stream_cached(self, frames: Iterable[Frame]) -> Iterator[Tuple[Frame, Optional[Detections]]]:
+        """Same as ``_detect_stream``, but the detections are read from the detection cache if they are stored
+        there, and stored there otherwise once the whole video has been detected."""
+        cache_key = self._detection_cache_key()
+        if cache_key is None:
+            yield from self._detect_stream(frames)
+            return
+
+        cached_detections = self.detection_cache.load(cache_key)
+        if cached_detections is not None:
+            yield from zip(frames, cached_detections)
+            return
+
+        detections_in_video = []
+        for frame, detections in self._detect_stream(frames):
+            detections_in_video.append(detections)
+            yield frame, detections
+        self.detection_cache.store(cache_key, detections_in_video)
+
+    def _detect_frames(self, frames: Sequence[Frame], n_jobs: int, shared_memory: bool) -> List[Detections]:
+        """Detects cars in the frames, in parallel if the car detector supports it.
+
+        The frames of a ``FrameStore`` are already shared by the processes through the page cache, so they are
+        never copied to shared memory.
+        """
+        if n_jobs == 1 or not self.car_detector.supports_multiprocessing:
+            return self.car_detector.detect_chunk(frames)
+        if shared_memory and not isinstance(frames, FrameStore):
+            return self._detect_with_shared_memory(frames, n_jobs)
+        return self._detect_with_pool(frames, n_jobs)
+
+    def _detect_video(self, frames: List[Frame], n_jobs: int, shared_memory: bool) -> List[Optional[Detections]]:
+        """Detects cars in all the frames of the video at once, in the frames selected by the frame skipper.
+
+        Returns:
+            The detections of each frame, or None for the frames where detection is skipped.
+        """
+        n_jobs = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+        selected_frames = [detect for _, detect in self._select_frames(frames)]
+        cache_key = self._detection_cache_key()
+        detections_in_video = self.detection_cache.load(cache_key) if cache_key is not None else None
+        if detections_in_video is None:
+            frames_to_detect = [frame for frame, detect in zip(frames, selected_frames) if detect]
+            if isinstance(self.video.frames, FrameStore) and len(frames_to_detect) == len(self.video.frames):
+                # The frames are detected in the store rather than in their copies, so that the workers get slices
+                # of it instead of the pixels
+                frames_to_detect = self.video.frames
+            detections_in_video = self._detect_frames(frames_to_detect, n_jobs, shared_memory)
+            if cache_key is not None:
+                self.detection_cache.store(cache_key, detections_in_video)
+
+        detections_in_video = iter(detections_in_video)
+        return [next(detections_in_video) if detect else None for detect in selected_frames]
+
+    def process_video(self, n_jobs: int = 1, shared_memory: bool = False) -> Video:
         """Processes the video and returns new video with detected cars.
+
+        When using multiprocessing, the video is split into contiguous chunks which are sent to the workers together
+        with the frames that precede them, so stateful detectors produce exactly the same rectangles as in a
+        sequential run.
+
+        Car detectors which do not support multiprocessing, like ``YoloDetector``, always run in the main process,
+        where they parallelize the detection themselves.
+
         Args:
             n_jobs: the number of jobs to use for multiprocessing. If set to 1, no multiprocessing is used.
+            shared_memory: whether to send the frames to the workers through shared memory instead of pickling them.
+                Only used if multiprocessing is used. Defaults to False.
 
         Returns:
             A new video with detected cars.
         """
-        n_jobs = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
-        new_frames = [deepcopy(frame) for frame in self.video]
-        # rectangles_in_video = self.car_detector.detect(self.video)
-        # Using multiprocessing to speed up the detection
-        with multiprocessing.Pool(n_jobs) as pool:
-            rectangles_in_video = pool.map(self.car_detector.detect_frame, new_frames)
-
-        for idx, rectangles in enumerate(rectangles_in_video):
-            rectangles_in_action_zone = [rectangle for rectangle in rectangles if rectangle in self.action_zone]
-            car_rectangles = [rectangle for rectangle in rectangles_in_action_zone
-                              if "car" in rectangle.label.lower()]
-            traces: List[List[Rectangle]] = self.tracker.track_cars(car_rectangles)
-            self._draw_scene(new_frames[idx], car_rectangles, traces)
+        # The whole video is read at once, which is recorded apart from the reading of single frames
+        with self.profiler.stage("read_video"):
+            new_frames = [deepcopy(frame) for frame in self.video]
+        for frame, detections in zip(new_frames, self._detect_video(new_frames, n_jobs, shared_memory)):
+            self._process_frame(frame, detections)
 
         return Video(frames=new_frames, fps=self.video.fps)
+
+    def _read_frames(self, queue_size: int) -> Iterator[Frame]:
+        """Yields the frames of the video, decoded in a background thread if it is streamed."""
+        def record_queue_depth(depth: int):
+            self.profiler.count("read_queue_depth", depth)
+
+        frames = self.video.iter_frames(prefetch_size=queue_size,
+                                        on_get=record_queue_depth if self.profiler.enabled else None)
+        try:
+            while True:
+                with self.profiler.stage("read"):
+                    frame = next(frames, None)
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            frames.close()
+
+    def process_video_headless(self, n_jobs: int = 1, shared_memory: bool = False,
+                               queue_size: int = 4) -> ProcessingResult:
+        """Detects and tracks the cars of the video without drawing or copying any frame.
+
+        When there is no multiprocessing the frames are streamed from a background thread, so the memory used does
+        not depend on the length of the video. If the detections are in the detection cache, the car detector does
+        not run, and a streamed video is not even decoded.
+
+        Args:
+            n_jobs: the number of jobs to use for multiprocessing. If set to 1, no multiprocessing is used.
+            shared_memory: whether to send the frames to the workers through shared memory instead of pickling them.
+                Only used if multiprocessing is used. Defaults to False.
+            queue_size: the maximum number of decoded frames waiting to be processed. Only used if there is no
+                multiprocessing. Defaults to 4.
+
+        Returns:
+            The cars tracked in each frame with the ids of their traces, and the final counters.
+        """
+        cache_key = self._detection_cache_key()
+        cached_detections = self.detection_cache.load(cache_key) if cache_key is not None else None
+        if cached_detections is not None:
+            detections_in_video = cached_detections
+        elif n_jobs == 1 or not self.car_detector.supports_multiprocessing:
+            detections_in_video = (detections for _, detections
+                                   in self._detect_stream_cached(self._read_frames(queue_size)))
+        else:
+            with self.profiler.stage("read_video"):
+                frames = list(self.video)
+            detections_in_video = self._detect_video(frames, n_jobs, shared_memory)
+
+        cars_in_frames, trace_ids_in_frames, detected_frames = [], [], []
+        for detections in detections_in_video:
+            cars_in_frames.append(self._track(detections))
+            trace_ids_in_frames.append(self.tracker.last_trace_ids)
+            detected_frames.append(detections is not None)
+
+        zone_counts = self.zone_counter.counts if self.zone_counter is not None else {}
+        return ProcessingResult.from_frames(cars_in_frames, trace_ids_in_frames, detected_frames,
+                                            self.tracker.car_counter, zone_counts, self.video.fps)
+
+    def iter_process_video(self, queue_size: int = 4) -> Iterator[Frame]:
+        """Processes the video lazily, yielding every new frame with the detected cars as soon as it is ready.
+
+        The frames are decoded in a background thread and handed over through a bounded queue, and only the frame
+        being processed is kept alive by this generator, so the memory used does not depend on the length of the
+        video. Detection runs in the calling thread in batches of the batch size of the car detector, hence stateful
+        detectors see the frames in order and batched detectors only keep a batch of frames alive.
+
+        If the video is not streamed, the frames are copied before drawing on them so that the video is not modified.
+
+        Args:
+            queue_size: the maximum number of decoded frames waiting to be processed. Defaults to 4.
+
+        Yields:
+            The processed frames, in order.
+        """
+        frames = self._read_frames(queue_size)
+        if not self.video.stream:
+            frames = (deepcopy(frame) for frame in frames)
+        for frame, detections in self._detect_stream_cached(frames):
+            self._process_frame(frame, detections)
+            yield frame
+
+    def process_video_to_file(self, path: str, queue_size: int = 4, codec: Optional[str] = None) -> None:
+        """Processes the video and writes the new video with detected cars to the given path.
+
+        The video is processed as a pipeline of three concurrent stages connected by bounded queues: a reader thread
+        decodes the frames, the calling thread detects, tracks and draws the cars and a writer thread encodes the
+        processed frames. Each frame is written as soon as it has been processed, so the whole new video is never
+        held in memory, and the time taken is close to the time of the slowest stage.
+
+        Args:
+            path: the path to save the new video. Its extension determines the container.
+            queue_size: the maximum number of frames waiting between two stages. Defaults to 4.
+            codec: the four character code of the codec. If None, a codec suitable for the container is chosen.
+                Defaults to None.
+        """
+        with VideoWriter(path, self.video.fps, self.video.size, codec, queue_size) as writer:
+            for frame in self.iter_process_video(queue_size):
+                with self.profiler.stage("write"):
+                    writer.write(frame)
+                self.profiler.count("write_queue_depth", writer.pending)
@@ -0,0 +1,162 @@
+"""Instrumentation of the processing of videos"""
+from typing import Callable, ContextManager, Dict, Iterable, List, Optional
+
+from contextlib import nullcontext
+from dataclasses import dataclass
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+@dataclass
+class ProfileEvent:
+    """A stage that took some time or a value of a counter.
+
+    Args:
+        name: the name of the stage or counter
+        start: the time when the stage started or the value was recorded, from ``time.perf_counter``
+        duration: the duration of the stage in seconds. It is 0 for counters.
+        value: the value of the counter. It is None for stages.
+        thread_id: the id of the thread where the event happened
+    """
+
+    name: str
+    start: float
+    duration: float = 0.0
+    value: Optional[float] = None
+    thread_id: int = 0
+
+
+class _Stage:
+    """Context manager that records the duration of a stage in a profiler."""
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler._record(ProfileEvent(self.name, self.start, time.perf_counter() - self.start,
+                                           thread_id=threading.get_ident()))
+
+
+_DISABLED_STAGE = nullcontext()
+
+
+class Profiler:
+    """Records how long each stage of the processing takes and the values of counters, like the number of
+    detections or the depth of a queue, once per frame.
+
+    A disabled profiler records nothing and its methods return immediately, so instrumented code costs almost nothing
+    when it is not profiled. A pickled profiler, e.g. sent to a worker process inside a car detector, is disabled.
+
+    Args:
+        enabled: whether to record. Defaults to True.
+        keep_events: whether to keep every event, which is needed to export a Chrome trace. Otherwise only the
+            durations and values are kept for the summary. Defaults to True.
+
+    Examples:
+        >>> profiler = Profiler()
+        >>> with profiler.stage("detect"):
+        ...     pass
+        >>> profiler.count("detections", 3)
+        >>> summary = profiler.summary()
+        >>> summary["stages"]["detect"]["count"], summary["counters"]["detections"]["mean"]
+        (1, 3.0)
+    """
+
+    def __init__(self, enabled: bool = True, keep_events: bool = True):
+        self.enabled = enabled
+        self.keep_events = keep_events
+        self.events: List[ProfileEvent] = []
+        self._durations: Dict[str, List[float]] = {}
+        self._values: Dict[str, List[float]] = {}
+        self._callbacks: List[Callable[[ProfileEvent], None]] = []
+        self._origin = time.perf_counter()
+
+    def stage(self, name: str) -> ContextManager:
+        """Returns a context manager that records the duration of the code it wraps as the stage with the name."""
+        return _Stage(self, name) if self.enabled else _DISABLED_STAGE
+
+    def count(self, name: str, value: float) -> None:
+        """Records the value of the counter with the name."""
+        if self.enabled:
+            self._record(ProfileEvent(name, time.perf_counter(), value=value, thread_id=threading.get_ident()))
+
+    def add_callback(self, callback: Callable[[ProfileEvent], None]) -> None:
+        """Calls the callback with every event recorded from now on, in the thread where it happens."""
+        self._callbacks.append(callback)
+
+    def merge(self, events: Iterable[ProfileEvent]) -> None:
+        """Records the events recorded by another profiler, e.g. in a worker process, where a pickled profiler is
+        disabled."""
+        if self.enabled:
+            for event in events:
+                self._record(event)
+
+    def _record(self, event: ProfileEvent) -> None:
+        # Appending to a list is atomic, so events can be recorded from several threads
+        if event.value is None:
+            self._durations.setdefault(event.name, []).append(event.duration)
+        else:
+            self._values.setdefault(event.name, []).append(event.value)
+        if self.keep_events:
+            self.events.append(event)
+        for callback in self._callbacks:
+            callback(event)
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Returns the statistics of each stage, with the durations in milliseconds, and of each counter."""
+        stages = {}
+        for name, durations in self._durations.items():
+            durations = np.array(durations) * 1000
+            p50, p90, p99 = np.percentile(durations, (50, 90, 99))
+            stages[name] = {"count": len(durations), "total_ms": float(durations.sum()),
+                            "mean_ms": float(durations.mean()), "p50_ms": float(p50), "p90_ms": float(p90),
+                            "p99_ms": float(p99), "max_ms": float(durations.max())}
+        counters = {name: {"count": len(values), "mean": float(np.mean(values)), "min": float(np.min(values)),
+                           "max": float(np.max(values))}
+                    for name, values in self._values.items()}
+        return {"stages": stages, "counters": counters}
+
+    def save_summary(self, path: str) -> None:
+        """Saves the summary as JSON."""
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def save_chrome_trace(self, path: str) -> None:
+        """Saves the events in the Chrome trace format, which can be opened in chrome://tracing or Perfetto to see
+        the stages of each thread as a flame chart.
+
+        Raises:
+            ValueError: if the events were not kept
+        """
+        if not self.keep_events:
+            raise ValueError("The events must be kept to export a Chrome trace.")
+        pid = os.getpid()
+        trace_events = []
+        for event in self.events:
+            timestamp = (event.start - self._origin) * 1e6
+            if event.value is None:
+                trace_events.append({"name": event.name, "ph": "X", "ts": timestamp, "dur": event.duration * 1e6,
+                                     "pid": pid, "tid": event.thread_id})
+            else:
+                trace_events.append({"name": event.name, "ph": "C", "ts": timestamp, "pid": pid,
+                                     "args": {event.name: event.value}})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+
+    def __reduce__(self):
+        return Profiler, (False,)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
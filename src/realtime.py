@@ -0,0 +1,197 @@
+"""Real-time processing of live sources, such as cameras or network streams"""
+from typing import Callable, Deque, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+from collections import deque
+import threading
+import time
+
+import cv2
+from dataclasses import dataclass, field
+import numpy as np
+
+from src.data_structures import Frame
+from src.processor import Processor
+
+
+@dataclass
+class RealTimeStats:
+    """Metrics of a real-time run.
+
+    Args:
+        frames_captured: the number of frames read from the source
+        frames_processed: the number of frames processed
+        frames_overwritten: the number of frames replaced by a newer one before being processed
+        frames_late: the number of frames discarded because they were older than the latency budget
+        latencies: the latencies, in seconds, from capture to the end of processing of the last processed frames
+    """
+
+    frames_captured: int = 0
+    frames_processed: int = 0
+    frames_overwritten: int = 0
+    frames_late: int = 0
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=10000))
+
+    @property
+    def frames_dropped(self) -> int:
+        return self.frames_overwritten + self.frames_late
+
+    def summary(self) -> Dict[str, float]:
+        """Returns the metrics as a dictionary, with the latencies in milliseconds."""
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            "frames_captured": self.frames_captured,
+            "frames_processed": self.frames_processed,
+            "frames_dropped": self.frames_dropped,
+            "drop_rate": self.frames_dropped / max(1, self.frames_captured),
+            "latency_mean_ms": float(latencies.mean()),
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p95_ms": float(np.percentile(latencies, 95)),
+            "latency_max_ms": float(latencies.max()),
+        }
+
+
+class LatestFrame:
+    """A slot that holds only the newest frame captured from a source, so consumers never fall behind it."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame: Optional[Tuple[Frame, float]] = None
+        self._closed = False
+
+    def put(self, frame: Frame, captured_at: float) -> bool:
+        """Stores the frame, replacing the previous one.
+
+        Returns:
+            Whether a frame which had not been consumed yet was replaced.
+        """
+        with self._condition:
+            overwritten = self._frame is not None
+            self._frame = (frame, captured_at)
+            self._condition.notify()
+        return overwritten
+
+    def get(self) -> Optional[Tuple[Frame, float]]:
+        """Waits for a new frame and returns it with its capture time, or None if the slot is closed and empty."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._frame is not None or self._closed)
+            frame, self._frame = self._frame, None
+            return frame
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class RealTimeRunner:
+    """Runs a processor on a live source in real time.
+
+    A capture thread reads the source as fast as it produces frames and keeps only the newest one. The processor
+    always takes the newest frame, so when it is slower than the source the frames in between are dropped instead of
+    accumulating latency. The latency of each frame and the dropped frames are recorded in ``stats``.
+
+    Args:
+        processor: the processor to run. Its video is used as source if no source is given.
+        source: the source of the frames: a path or URL of a video, the index of a camera or any iterable of frames,
+            e.g. a generator of synthetic frames. Defaults to None.
+        latency_budget: the maximum time, in seconds, between the capture of a frame and the start of its
+            processing. Older frames are dropped. If None, the newest frame is always processed. Defaults to None.
+        pace: whether to read the source at its frame rate, to emulate a live source with a video file or an
+            iterable. If None, files and iterables are paced and cameras and URLs are not. Defaults to None.
+        fps: the frame rate used to pace the source. If None, the frame rate of the video is used, or 30 if it
+            is not known. Defaults to None.
+
+    Raises:
+        ValueError: if no source is given and the processor has no video
+    """
+
+    def __init__(self,
+                 processor: Processor,
+                 source: Optional[Union[str, int, Iterable[Frame]]] = None,
+                 latency_budget: Optional[float] = None,
+                 pace: Optional[bool] = None,
+                 fps: Optional[float] = None):
+        if source is None:
+            if processor.video is None:
+                raise ValueError("A source must be given if the processor has no video.")
+            source = processor.video.path
+        self.processor = processor
+        self.source = source
+        self.latency_budget = latency_budget
+        is_live = isinstance(source, int) or (isinstance(source, str) and "://" in source)
+        self.pace = not is_live if pace is None else pace
+        video_fps = processor.video.fps if processor.video is not None else 0
+        self.fps = fps or video_fps or 30
+        self.stats = RealTimeStats()
+        self._latest_frame = LatestFrame()
+        self._stop = threading.Event()
+
+    def _read_source(self) -> Iterator[Frame]:
+        if not isinstance(self.source, (str, int)):
+            yield from self.source
+            return
+
+        video_capture = cv2.VideoCapture(self.source)
+        try:
+            while not self._stop.is_set():
+                ret, image = video_capture.read()
+                if not ret:
+                    break
+                yield Frame(image)
+        finally:
+            video_capture.release()
+
+    def _capture(self) -> None:
+        interval = 1 / self.fps
+        next_capture = time.perf_counter()
+        try:
+            for frame in self._read_source():
+                if self._stop.is_set():
+                    break
+                if self.pace:
+                    time.sleep(max(0.0, next_capture - time.perf_counter()))
+                    next_capture += interval
+                self.stats.frames_captured += 1
+                if self._latest_frame.put(frame, time.perf_counter()):
+                    self.stats.frames_overwritten += 1
+        finally:
+            self._latest_frame.close()
+
+    def stop(self) -> None:
+        """Stops the run after the frame being processed."""
+        self._stop.set()
+
+    def run(self,
+            on_frame: Optional[Callable[[Frame], None]] = None,
+            max_frames: Optional[int] = None) -> RealTimeStats:
+        """Processes the source until it ends, ``stop`` is called or ``max_frames`` frames have been processed.
+
+        Args:
+            on_frame: function called with every processed frame, e.g. to show or write it. Its time counts in the
+                latency. Defaults to None.
+            max_frames: the maximum number of frames to process. Defaults to None.
+
+        Returns:
+            The metrics of the run.
+        """
+        capture_thread = threading.Thread(target=self._capture, daemon=True)
+        capture_thread.start()
+        try:
+            while not self._stop.is_set() and (max_frames is None or self.stats.frames_processed < max_frames):
+                captured = self._latest_frame.get()
+                if captured is None:
+                    break
+                frame, captured_at = captured
+                if self.latency_budget is not None and time.perf_counter() - captured_at > self.latency_budget:
+                    self.stats.frames_late += 1
+                    continue
+
+                self.processor.process_frame(frame)
+                if on_frame is not None:
+                    on_frame(frame)
+                self.stats.latencies.append(time.perf_counter() - captured_at)
+                self.stats.frames_processed += 1
+        finally:
+            self.stop()
+            capture_thread.join()
+        return self.stats
@@ -0,0 +1,380 @@
+"""Processing of a single long video with several processes, by splitting it in time shards"""
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from copy import deepcopy
+import itertools
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+
+from src.car_detectors.car_detector import CarDetector
+from src.data_structures import Detections, ProcessingResult, Rectangle, Video, VideoWriter
+from src.processor import Processor
+from src.profiling import ProfileEvent, Profiler
+from src.tracker import Tracker
+from src.zones import CountLine, Zone, ZoneCounter
+
+
+class _ReplayTracker(Tracker):
+    """Tracker which gives the cars of each frame the trace ids found when the video was tracked, so that a shard
+    can be drawn without tracking its cars again.
+
+    Only the active traces are kept, and the car counter is updated as the traces grow, as in ``AssignmentTracker``.
+
+    Args:
+        min_trace_length: minimum length of a trace to be considered a car.
+    """
+
+    def __init__(self, min_trace_length: int):
+        super().__init__(min_trace_length=min_trace_length)
+        self.trace_ids_in_frames: Iterator[List[int]] = iter(())
+        self._car_counter = 0
+
+    @property
+    def car_counter(self) -> int:
+        return self._car_counter
+
+    def track_cars(self, new_rectangles_set) -> List[List[Rectangle]]:
+        trace_ids = next(self.trace_ids_in_frames)
+        min_trace_length = max(1, self.min_trace_length)
+        for trace_id, car in zip(trace_ids, new_rectangles_set):
+            if len(self._add_to_trace(trace_id, car)) == min_trace_length:
+                self._car_counter += 1
+
+        active_traces = set(trace_ids)
+        for trace_id in self.active_traces - active_traces:
+            del self.traces[trace_id]
+        self.active_traces = active_traces
+        self.last_trace_ids = list(trace_ids)
+        return [self.traces[trace_id] for trace_id in self.active_traces]
+
+
+class _ReplayZoneCounter:
+    """Stands for the ``ZoneCounter`` of a processor when a shard is drawn, giving the counts of each frame found
+    when the video was tracked."""
+
+    def __init__(self, zones: Sequence[Union[Zone, CountLine]], counts_in_frames: List[Dict[str, int]],
+                 counts: Dict[str, int]):
+        self.zones = list(zones)
+        self.counts = counts
+        self._counts_in_frames = iter(counts_in_frames)
+
+    def update(self, cars: Detections, trace_ids: Sequence[int]) -> None:
+        self.counts = next(self._counts_in_frames)
+
+
+def stitch_trace_ids(trace_ids_in_shards: Sequence[Sequence[Sequence[int]]]) -> List[List[int]]:
+    """Gives global ids to the traces found independently in each shard of a video.
+
+    The first frame of every shard but the first one must be the last frame of the previous shard, tracked again to
+    restore the state of the tracker. Its traces are continued with the ids they have in the previous shard, and the
+    other traces of the shard get new ids in the order in which they appear, as a single tracker would give them.
+
+    Args:
+        trace_ids_in_shards: the trace ids of the cars of each frame of each shard, as given by the tracker of the
+            shard
+
+    Returns:
+        The global trace ids of the cars of each frame of the video, without the repeated frames.
+
+    Examples:
+        >>> stitch_trace_ids([[[1], [1, 2]], [[1, 2], [2, 3]], [[1, 2], [2, 3]]])
+        [[1], [1, 2], [2, 3], [3, 4]]
+    """
+    trace_ids_in_video: List[List[int]] = []
+    last_id = 0
+    for shard_index, trace_ids_in_frames in enumerate(trace_ids_in_shards):
+        global_ids = {}
+        if shard_index > 0:
+            global_ids = dict(zip(trace_ids_in_frames[0], trace_ids_in_video[-1]))
+            trace_ids_in_frames = trace_ids_in_frames[1:]
+        for trace_ids in trace_ids_in_frames:
+            for trace_id in trace_ids:
+                if trace_id not in global_ids:
+                    last_id += 1
+                    global_ids[trace_id] = last_id
+            trace_ids_in_video.append([global_ids[trace_id] for trace_id in trace_ids])
+    return trace_ids_in_video
+
+
+def _running_counts(trace_ids_in_frames: Sequence[Sequence[int]], min_trace_length: int) -> List[int]:
+    """Returns the value of the car counter of a tracker after each frame, given the trace ids of its cars."""
+    min_trace_length = max(1, min_trace_length)
+    lengths: Dict[int, int] = {}
+    counts = []
+    count = 0
+    for trace_ids in trace_ids_in_frames:
+        for trace_id in trace_ids:
+            lengths[trace_id] = lengths.get(trace_id, 0) + 1
+            count += lengths[trace_id] == min_trace_length
+        counts.append(count)
+    return counts
+
+
+def _track_shard(car_detector: CarDetector,
+                 tracker: Tracker,
+                 path: str,
+                 action_zone: Rectangle,
+                 start: int,
+                 stop: Optional[int],
+                 queue_size: int,
+                 detections_in_frames: Optional[List[Detections]],
+                 keep_detections: bool,
+                 profile: bool) -> Tuple[List[Detections], List[List[int]], Optional[List[Detections]],
+                                         List[ProfileEvent]]:
+    """Detects and tracks the cars of the frames in ``[start, stop)``, and of the frame before them if any.
+
+    If the detections of these frames are given, e.g. from a detection cache, the frames are not even decoded.
+
+    Returns:
+        The cars of each frame, the ids of their traces, the detections of each frame if they are kept, and the
+        events recorded if the shard is profiled.
+    """
+    profiler = Profiler() if profile else None
+    processor = Processor(car_detector, path, action_zone, tracker, stream=True, profiler=profiler)
+    # The frame before the shard is tracked again to restore the tracker, and the frames before it restore the state
+    # of the car detector
+    first_tracked = max(0, start - 1)
+    if detections_in_frames is None:
+        first_read = max(0, first_tracked - car_detector.context_frames)
+        processor.video = Video(path, stream=True, start=first_read, stop=stop)
+        frames = processor._read_frames(queue_size)
+        car_detector.reset()
+        for frame in itertools.islice(frames, first_tracked - first_read):
+            car_detector.detect_frame(frame)
+        detections_in_frames = (detections for _, detections in car_detector.detect_stream(frames))
+
+    cars_in_frames, trace_ids_in_frames, kept_detections = [], [], []
+    for detections in detections_in_frames:
+        if keep_detections:
+            kept_detections.append(detections)
+        cars_in_frames.append(processor._track(detections))
+        trace_ids_in_frames.append(processor.tracker.last_trace_ids)
+    return (cars_in_frames, trace_ids_in_frames, kept_detections if keep_detections else None,
+            profiler.events if profile else [])
+
+
+def _render_shard(path: str,
+                  action_zone: Rectangle,
+                  tracker: _ReplayTracker,
+                  zone_counter: Optional[_ReplayZoneCounter],
+                  start: int,
+                  stop: Optional[int],
+                  cars_in_frames: List[Detections],
+                  segment_path: str,
+                  codec: Optional[str],
+                  queue_size: int,
+                  profile: bool) -> List[ProfileEvent]:
+    """Draws the tracked cars on the frames in ``[start, stop)`` and writes them to a segment of the new video.
+
+    Returns:
+        The events recorded if the shard is profiled.
+    """
+    profiler = Profiler() if profile else None
+    # Nothing is detected when drawing, so there is no car detector
+    processor = Processor(None, path, action_zone, tracker, stream=True)
+    if profiler is not None:
+        processor.profiler = profiler
+    processor.zone_counter = zone_counter
+    processor.video = Video(path, stream=True, start=start, stop=stop)
+    with VideoWriter(segment_path, processor.video.fps, processor.video.size, codec, queue_size) as writer:
+        for frame, cars in zip(processor._read_frames(queue_size), cars_in_frames):
+            processor._process_frame(frame, cars)
+            with processor.profiler.stage("write"):
+                writer.write(frame)
+    return profiler.events if profile else []
+
+
+def _concatenate_videos(paths: Sequence[str], output_path: str, codec: Optional[str] = None) -> None:
+    """Joins videos with the same size, frame rate and codec into one.
+
+    If ffmpeg is installed the videos are joined without encoding them again. Otherwise, their frames are decoded and
+    encoded again with OpenCV.
+    """
+    if shutil.which("ffmpeg"):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+            file.writelines(f"file '{os.path.abspath(path)}'\n" for path in paths)
+        try:
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", file.name,
+                            "-c", "copy", output_path], check=True)
+        finally:
+            os.remove(file.name)
+        return
+
+    first_video = Video(paths[0], stream=True)
+    with VideoWriter(output_path, first_video.fps, first_video.size, codec) as writer:
+        for path in paths:
+            for frame in Video(path, stream=True):
+                writer.write(frame)
+
+
+class ShardedProcessor:
+    """Processes a single long video with several processes by splitting it in contiguous time shards.
+
+    The video is processed in two passes, both of which run a process per shard that seeks to the first frame of its
+    shard and decodes only its frames:
+
+    1. Each shard is detected and tracked with a copy of the car detector and the tracker of the processor. The
+       frame before the shard (and the context frames of the car detector before it) is processed again to restore
+       their state, so each trace that crosses the start of a shard is continued there. The main process then gives
+       global ids to the traces of the shards and computes the counters of the action zone and of the zones, see
+       ``stitch_trace_ids``.
+    2. If a new video is written, each shard is drawn with the global ids and counters and encoded as a segment, and
+       the segments are joined.
+
+    The result is the same as the one of the processor as long as the detections of a frame only depend on the frame
+    and the ``context_frames`` frames before it, and the tracker only depends on the cars of the previous frame, as
+    ``AssignmentTracker`` does. ``Tracker`` may break ties between traces at the same distance of a car differently,
+    and ``BackgroundSubtractionDetector`` learns the background again at the start of each shard. Seeking is exact
+    for intra-frame codecs like MJPG, but may not be for other codecs.
+
+    The detection cache of the processor is used as in ``Processor.process_video_headless``: if the detections of
+    the video are stored there, the shards only track them, and otherwise they are stored there at the end. The
+    stages recorded by the processes of the shards are merged into the profiler of the processor.
+
+    Args:
+        processor: the processor whose car detector, tracker, action zone, zones, detection cache and profiler are
+            used. It must stream its video, so that the video is not decoded in the main process, and its tracker
+            must not have tracked any car yet.
+        n_shards: the number of shards, each processed by its own process. If -1, the number of CPUs. Defaults to -1.
+        queue_size: the maximum number of frames waiting between two stages in each process. Defaults to 4.
+
+    Raises:
+        ValueError: if the processor has no video file, does not stream it, skips frames or its tracker has already
+            tracked cars
+    """
+
+    def __init__(self, processor: Processor, n_shards: int = -1, queue_size: int = 4):
+        if processor.video is None or not processor.video.path:
+            raise ValueError("Only the videos read from a file can be split in shards.")
+        if not processor.video.stream:
+            raise ValueError("The processor must stream its video (stream=True), otherwise the whole video is decoded "
+                             "in the main process.")
+        if processor.frame_skipper is not None:
+            raise ValueError("Frame skipping is not supported when the video is split in shards, since the tracker "
+                             "predicts the cars of the skipped frames from the previous ones.")
+        if processor.tracker.last_id:
+            raise ValueError("The tracker of the processor must not have tracked any car yet.")
+        self.processor = processor
+        self.n_shards = n_shards if n_shards > 0 else multiprocessing.cpu_count()
+        self.queue_size = queue_size
+
+    def _shards(self) -> List[Tuple[int, Optional[int]]]:
+        """Returns the (start, stop) frame indices of each shard. The last one is read until the end of the video,
+        since the number of frames of a video is not always exact."""
+        chunks = self.processor._split_in_chunks(0, len(self.processor.video), self.n_shards)
+        shards = [(chunk.start, chunk.stop) for chunk, _ in chunks] or [(0, None)]
+        shards[-1] = (shards[-1][0], None)
+        return shards
+
+    def _zones(self) -> Optional[List[Union[Zone, CountLine]]]:
+        zone_counter = self.processor.zone_counter
+        return zone_counter.zones if zone_counter is not None else None
+
+    def _track(self, shards: List[Tuple[int, Optional[int]]]) -> Tuple[List[Detections], List[List[int]],
+                                                                           List[Dict[str, int]]]:
+        """Detects and tracks the cars of every shard in parallel and stitches their traces.
+
+        Returns:
+            The cars of each frame of the video, their global trace ids and the count of each zone after each frame.
+        """
+        processor = self.processor
+        cache_key = processor._detection_cache_key()
+        cached_detections = processor.detection_cache.load(cache_key) if cache_key is not None else None
+        store_detections = cache_key is not None and cached_detections is None
+        tasks = [(processor.car_detector, processor.tracker, processor.video.path, processor.action_zone, start, stop,
+                  self.queue_size,
+                  cached_detections[max(0, start - 1):stop] if cached_detections is not None else None,
+                  store_detections, processor.profiler.enabled)
+                 for start, stop in shards]
+        with multiprocessing.Pool(len(shards)) as pool:
+            with processor.profiler.stage("track_shards"):
+                results = pool.starmap(_track_shard, tasks)
+        for *_, events in results:
+            processor.profiler.merge(events)
+        if store_detections:
+            processor.detection_cache.store(cache_key, [detections for shard_index, result in enumerate(results)
+                                                        for detections in result[2][1 if shard_index else 0:]])
+
+        with processor.profiler.stage("stitch"):
+            cars_in_frames = [cars for shard_index, (cars_in_shard, *_) in enumerate(results)
+                              for cars in cars_in_shard[1 if shard_index else 0:]]
+            trace_ids_in_frames = stitch_trace_ids([trace_ids for _, trace_ids, *_ in results])
+            zone_counts_in_frames = [{} for _ in cars_in_frames]
+            if self._zones():
+                # The zones only count the global trace ids, so they are counted once for the whole video
+                zone_counter = ZoneCounter(self._zones(), processor.frame_size,
+                                           processor.tracker.min_trace_length)
+                for cars, trace_ids, counts in zip(cars_in_frames, trace_ids_in_frames, zone_counts_in_frames):
+                    zone_counter.update(cars, trace_ids)
+                    counts.update(zone_counter.counts)
+        return cars_in_frames, trace_ids_in_frames, zone_counts_in_frames
+
+    def _result(self, cars_in_frames: List[Detections], trace_ids_in_frames: List[List[int]],
+                zone_counts_in_frames: List[Dict[str, int]]) -> ProcessingResult:
+        car_counts = _running_counts(trace_ids_in_frames, self.processor.tracker.min_trace_length)
+        zone_counts = zone_counts_in_frames[-1] if zone_counts_in_frames else {}
+        return ProcessingResult.from_frames(cars_in_frames, trace_ids_in_frames, [True] * len(cars_in_frames),
+                                            car_counts[-1] if car_counts else 0, zone_counts, self.processor.video.fps)
+
+    def process_video_headless(self) -> ProcessingResult:
+        """Detects and tracks the cars of the video without drawing any frame.
+
+        Returns:
+            The cars tracked in each frame with the ids of their traces, and the final counters.
+        """
+        return self._result(*self._track(self._shards()))
+
+    def process_video_to_file(self, path: str, codec: Optional[str] = None) -> ProcessingResult:
+        """Processes the video and writes the new video with detected cars to the given path.
+
+        Args:
+            path: the path to save the new video. Its extension determines the container.
+            codec: the four character code of the codec. If None, a codec suitable for the container is chosen.
+                Defaults to None.
+
+        Returns:
+            The cars tracked in each frame with the ids of their traces, and the final counters.
+        """
+        shards = self._shards()
+        cars_in_frames, trace_ids_in_frames, zone_counts_in_frames = self._track(shards)
+        processor = self.processor
+
+        # The traces which cross the start of each shard are replayed up to it in this process
+        tracker = _ReplayTracker(processor.tracker.min_trace_length)
+        zones = self._zones()
+        zone_counts = {zone.name: 0 for zone in zones} if zones else {}
+        extension = os.path.splitext(path)[1]
+        with tempfile.TemporaryDirectory() as directory:
+            tasks = []
+            for shard_index, (start, stop) in enumerate(shards):
+                stop_index = len(cars_in_frames) if stop is None else stop
+                zone_counter = (_ReplayZoneCounter(zones, zone_counts_in_frames[start:stop_index], zone_counts)
+                                if zones else None)
+                tracker.trace_ids_in_frames = iter(trace_ids_in_frames[start:stop_index])
+                tasks.append((processor.video.path, processor.action_zone, deepcopy(tracker), zone_counter, start,
+                              stop, cars_in_frames[start:stop_index],
+                              os.path.join(directory, f"{shard_index}{extension}"), codec, self.queue_size,
+                              processor.profiler.enabled))
+                for cars in cars_in_frames[start:stop_index]:
+                    tracker.track_cars(cars)
+                if zones and stop_index > start:
+                    zone_counts = zone_counts_in_frames[stop_index - 1]
+
+            with multiprocessing.Pool(len(shards)) as pool:
+                with processor.profiler.stage("render_shards"):
+                    events_in_shards = pool.starmap(_render_shard, tasks)
+            for events in events_in_shards:
+                processor.profiler.merge(events)
+            with processor.profiler.stage("concatenate"):
+                _concatenate_videos([task[7] for task in tasks], path, codec)
+
+        return self._result(cars_in_frames, trace_ids_in_frames, zone_counts_in_frames)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -1,17 +1,20 @@
 from typing import List, Union, Dict, Set
 
 from collections import defaultdict
+import numpy as np
 
-from src.data_structures import Rectangle
+from src.data_structures import Detections, Rectangle
 
 
 class Tracker:
     """This class keeps track of the objects that are in the action zone.
 
-    In particular, it keeps track of the traces of the objects and assigns an id to each object.
+    In particular, it keeps track of the traces of the objects and assigns an id to each object. The ids assigned
+    in the last frame are kept in ``last_trace_ids``, in the order of the cars.
 
     Args:
-        tol: tolerance for the distance between the center of two rectangles to be considered the same object.
+        tol: tolerance for the distance between the center of two rectangles to be considered the same object, per
+            frame since the object was last detected, see ``predict_cars``.
         min_trace_length: minimum length of a trace to be considered a car.
     """
 
@@ -21,17 +24,25 @@ class Tracker:
         self.tol = tol
         self.traces: Dict[int, List[Rectangle]] = defaultdict(list)
         self.active_traces: Set[int] = set()
+        # The trace id of each car given to the last call to track_cars, or of each car moved by predict_cars
+        self.last_trace_ids: List[int] = []
+        # Number of predicted rectangles at the end of each trace, see predict_cars
+        self._n_predicted: Dict[int, int] = {}
 
     @property
     def car_counter(self) -> int:
         return len([trace for trace in self.traces.values() if len(trace) >= self.min_trace_length])
 
+    def _tolerance(self, trace_id: int) -> float:
+        """Returns the tolerance of the trace, which grows with the number of frames since its car was detected."""
+        return self.tol * (self._n_predicted.get(trace_id, 0) + 1)
+
     def _set_car_id(self, car: Rectangle) -> int:
         """Returns the id of the car."""
         old_cars = [self.traces[trace_id][-1] for trace_id in self.active_traces]
         distances = [car.distance_to(old_car) for old_car in old_cars]
         potential_candidates = [(trace_id, distance) for trace_id, distance in zip(self.active_traces, distances)
-                                if distance <= self.tol]
+                                if distance <= self._tolerance(trace_id)]
         if not potential_candidates:
             self.last_id += 1
             return self.last_id
@@ -46,11 +57,167 @@ class Tracker:
 
         """
         active_traces = set()
+        trace_ids = []
         for car in new_rectangles_set:
             trace_id = self._set_car_id(car)
             active_traces.add(trace_id)
-            self.traces[trace_id].append(car)
+            trace_ids.append(trace_id)
+            self._add_to_trace(trace_id, car)
 
         self.active_traces = active_traces
+        self.last_trace_ids = trace_ids
+        self._forget_predictions(active_traces)
 
         return [self.traces[trace_id] for trace_id in self.active_traces]
+
+    def _add_to_trace(self, trace_id: int, car: Rectangle) -> List[Rectangle]:
+        """Appends the car to the trace.
+
+        If the last rectangles of the trace were predicted, they are replaced by rectangles interpolated between the
+        last detected car of the trace and the new one, which are much closer to where the car really was.
+        """
+        trace = self.traces[trace_id]
+        n_predicted = self._n_predicted.pop(trace_id, 0)
+        if n_predicted:
+            last_car = trace[-n_predicted - 1]
+            trace[-n_predicted:] = [self._interpolate(last_car, car, (i + 1) / (n_predicted + 1))
+                                    for i in range(n_predicted)]
+        trace.append(car)
+        return trace
+
+    def _forget_predictions(self, active_traces: Set[int]) -> None:
+        if self._n_predicted:
+            self._n_predicted = {trace_id: n_predicted for trace_id, n_predicted in self._n_predicted.items()
+                                 if trace_id in active_traces}
+
+    @staticmethod
+    def _interpolate(car_a: Rectangle, car_b: Rectangle, t: float) -> Rectangle:
+        """Returns the rectangle at the fraction t of the way from car_a to car_b."""
+        return Rectangle(*(round(a + (b - a) * t) for a, b in zip(car_a, car_b)), label=car_b.label)
+
+    @staticmethod
+    def _predict(trace: List[Rectangle]) -> Rectangle:
+        """Returns the position of the car of the trace in the next frame, assuming it keeps a constant velocity."""
+        last_car = trace[-1]
+        if len(trace) < 2:
+            return last_car
+        previous_car = trace[-2]
+        return Rectangle(2 * last_car.x - previous_car.x, 2 * last_car.y - previous_car.y,
+                         last_car.width, last_car.height, label=last_car.label)
+
+    def predict_cars(self) -> List[List[Rectangle]]:
+        """Moves the active traces one frame forward without new detections, e.g. in frames where detection is
+        skipped.
+
+        The position of each car is extrapolated from its last two positions. The predicted rectangles are appended
+        to the traces, so they are drawn and counted as the detected ones, and they are replaced by interpolated
+        rectangles when the car is detected again. The speed of a car detected only once is not known, so it is
+        predicted to stay still, and the tolerance of a trace is multiplied by the number of frames since its car
+        was detected, so that the car is still matched to it when it is detected again.
+
+        Returns:
+            The active traces.
+        """
+        self.last_trace_ids = list(self.active_traces)
+        for trace_id in self.last_trace_ids:
+            trace = self.traces[trace_id]
+            trace.append(self._predict(trace))
+            self._n_predicted[trace_id] = self._n_predicted.get(trace_id, 0) + 1
+        return [self.traces[trace_id] for trace_id in self.last_trace_ids]
+
+
+class AssignmentTracker(Tracker):
+    """Tracker which matches all the cars of a frame to the active traces at once.
+
+    The distances between the new cars and the last car of every active trace are computed as a matrix, and the
+    pairs closer than ``tol`` are matched greedily, closest first, so that a trace is continued by at most one car.
+    The car counter is updated as traces grow, and the traces which are no longer active are retired, so the cost
+    of a frame does not depend on the number of traces seen before.
+
+    Args:
+        tol: tolerance for the distance between the center of two rectangles to be considered the same object, per
+            frame since the object was last detected.
+        min_trace_length: minimum length of a trace to be considered a car.
+        keep_history: whether to keep the rectangles of the retired traces in ``traces``. Defaults to False.
+    """
+
+    def __init__(self, tol: Union[float, int] = 10, min_trace_length: int = 10, keep_history: bool = False):
+        super().__init__(tol, min_trace_length)
+        self.keep_history = keep_history
+        self._car_counter = 0
+        self._active_ids = np.empty(0, dtype=np.int64)
+        self._active_centers = np.empty((0, 2), dtype=np.int64)
+
+    @property
+    def car_counter(self) -> int:
+        return self._car_counter
+
+    def _match(self, cars: Detections) -> np.ndarray:
+        """Returns the index in the active traces of the trace matched to each car, or -1 if it is a new car."""
+        matches = np.full(len(cars), -1, dtype=np.int64)
+        if len(cars) == 0 or len(self._active_ids) == 0:
+            return matches
+
+        distances = cars.distances_to(self._active_centers)
+        tolerances = np.array([self._tolerance(trace_id) for trace_id in self._active_ids.tolist()])
+        car_indices, trace_indices = np.nonzero(distances <= tolerances[None, :])
+        order = np.argsort(distances[car_indices, trace_indices], kind="stable")
+        matched_traces = np.zeros(len(self._active_ids), dtype=bool)
+        for car_index, trace_index in zip(car_indices[order].tolist(), trace_indices[order].tolist()):
+            if matches[car_index] < 0 and not matched_traces[trace_index]:
+                matches[car_index] = trace_index
+                matched_traces[trace_index] = True
+        return matches
+
+    def track_cars(self, new_rectangles_set) -> List[List[Rectangle]]:
+        """Assigns the new cars to the active traces and returns the traces that are still active.
+
+        Args:
+            new_rectangles_set: the new rectangles to track
+        """
+        cars = Detections.from_rectangles(new_rectangles_set)
+        matches = self._match(cars)
+        is_new = matches < 0
+        trace_ids = self._active_ids[np.maximum(matches, 0)] if len(self._active_ids) else matches.copy()
+        trace_ids[is_new] = np.arange(self.last_id + 1, self.last_id + 1 + np.count_nonzero(is_new))
+        self.last_id += int(np.count_nonzero(is_new))
+
+        min_trace_length = max(1, self.min_trace_length)
+        traces = []
+        for trace_id, car in zip(trace_ids.tolist(), cars):
+            trace = self._add_to_trace(trace_id, car)
+            if len(trace) == min_trace_length:
+                self._car_counter += 1
+            traces.append(trace)
+
+        active_traces = set(trace_ids.tolist())
+        if not self.keep_history:
+            for trace_id in self.active_traces - active_traces:
+                del self.traces[trace_id]
+        self.active_traces = active_traces
+        self.last_trace_ids = trace_ids.tolist()
+        self._forget_predictions(active_traces)
+        self._active_ids = trace_ids
+        self._active_centers = cars.centers
+
+        return traces
+
+    def predict_cars(self) -> List[List[Rectangle]]:
+        """Moves the active traces one frame forward without new detections, e.g. in frames where detection is
+        skipped.
+
+        Returns:
+            The active traces.
+        """
+        min_trace_length = max(1, self.min_trace_length)
+        traces = []
+        self.last_trace_ids = self._active_ids.tolist()
+        for trace_id in self.last_trace_ids:
+            trace = self.traces[trace_id]
+            trace.append(self._predict(trace))
+            self._n_predicted[trace_id] = self._n_predicted.get(trace_id, 0) + 1
+            traces.append(trace)
+            if len(trace) == min_trace_length:
+                self._car_counter += 1
+        self._active_centers = np.array([trace[-1].center for trace in traces], dtype=np.int64).reshape(-1, 2)
+        return traces
@@ -0,0 +1,175 @@
+"""Contains the zones and count lines in which cars are counted separately, and the spatial index used to find the
+zones of the detections of a frame"""
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import cv2
+from dataclasses import dataclass
+import numpy as np
+
+from src.data_structures import Detections, Point, Rectangle
+
+
+@dataclass(frozen=True)
+class Zone:
+    """A polygonal region of the frame in which cars are counted separately.
+
+    A car is in the zone when the center of its rectangle is.
+
+    Args:
+        name: the name of the zone
+        polygon: the vertices of the zone
+        min_trace_length: minimum number of frames a car must be in the zone to be counted. Defaults to 10.
+    """
+
+    name: str
+    polygon: Tuple[Point, ...]
+    min_trace_length: int = 10
+
+    @classmethod
+    def from_rectangle(cls, name: str, rectangle: Rectangle, min_trace_length: int = 10) -> "Zone":
+        x, y, w, h = rectangle
+        return cls(name, ((x, y), (x + w, y), (x + w, y + h), (x, y + h)), min_trace_length)
+
+    def rasterize(self, mask: np.ndarray) -> None:
+        """Sets to 1 the pixels of the mask that belong to the zone."""
+        cv2.fillPoly(mask, [np.array(self.polygon, dtype=np.int32)], 1)
+
+
+@dataclass(frozen=True)
+class CountLine:
+    """A line of the frame, e.g. the entry or the exit of a road, which counts the cars that cross it.
+
+    The line is treated as a zone as thick as ``thickness`` pixels, so it must be thick enough for the cars to be
+    seen on it in at least ``min_trace_length`` frames.
+
+    Args:
+        name: the name of the line
+        start: one end of the line
+        end: the other end of the line
+        thickness: the thickness of the line in pixels. Defaults to 21.
+        min_trace_length: minimum number of frames a car must be on the line to be counted. Defaults to 3.
+    """
+
+    name: str
+    start: Point
+    end: Point
+    thickness: int = 21
+    min_trace_length: int = 3
+
+    @property
+    def polygon(self) -> Tuple[Point, ...]:
+        return self.start, self.end
+
+    def rasterize(self, mask: np.ndarray) -> None:
+        """Sets to 1 the pixels of the mask that belong to the line."""
+        cv2.line(mask, self.start, self.end, 1, self.thickness)
+
+
+class ZoneIndex:
+    """Spatial index of a set of zones, which finds the zones of many points with a single lookup.
+
+    The zones are rasterized once into a mask with the size of the frame, in which each pixel holds a bit set with
+    the zones it belongs to, so zones can overlap.
+
+    Args:
+        zones: the zones to index. At most 64.
+        frame_size: the size of the frames as (width, height)
+
+    Raises:
+        ValueError: if there are more than 64 zones
+    """
+
+    def __init__(self, zones: Sequence[Union[Zone, CountLine]], frame_size: Tuple[int, int]):
+        if len(zones) > 64:
+            raise ValueError(f"At most 64 zones can be indexed, got {len(zones)}.")
+        self.zones = list(zones)
+        width, height = frame_size
+        dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+                     if np.iinfo(dtype).bits >= len(self.zones))
+        self.mask = np.zeros((height, width), dtype=dtype)
+        zone_mask = np.zeros((height, width), dtype=np.uint8)
+        for bit, zone in enumerate(self.zones):
+            zone_mask[:] = 0
+            zone.rasterize(zone_mask)
+            self.mask[zone_mask > 0] |= dtype(1) << dtype(bit)
+        self._bits = np.arange(len(self.zones), dtype=dtype)
+
+    def lookup(self, points: np.ndarray) -> np.ndarray:
+        """Finds the zones each point belongs to.
+
+        Args:
+            points: array with shape (N, 2) with the x and y coordinates of the points
+
+        Returns:
+            A boolean array with shape (N, number of zones).
+        """
+        height, width = self.mask.shape
+        points = np.asarray(points).reshape(-1, 2)
+        x = np.clip(points[:, 0], 0, width - 1)
+        y = np.clip(points[:, 1], 0, height - 1)
+        inside_frame = (points[:, 0] == x) & (points[:, 1] == y)
+        zone_bits = np.where(inside_frame, self.mask[y, x], 0).astype(self.mask.dtype)
+        return ((zone_bits[:, None] >> self._bits[None, :]) & 1).astype(bool)
+
+
+class ZoneCounter:
+    """Counts the cars in each of a set of zones, using the trace ids given to the cars by the tracker of the action
+    zone.
+
+    A trace is counted in a zone once it is long enough to be counted as a car by the tracker and has been in the
+    zone in ``min_trace_length`` frames, and it is counted at most once, so a car whose center goes in and out of a
+    thin count line while it crosses it is counted a single time. Only the cars tracked in the action zone are
+    counted.
+
+    Args:
+        zones: the zones where to count cars. Their names must be different.
+        frame_size: the size of the frames as (width, height)
+        min_trace_length: minimum length of a trace to be considered a car, as in the tracker. Defaults to 10.
+
+    Raises:
+        ValueError: if two zones have the same name
+    """
+
+    def __init__(self, zones: Sequence[Union[Zone, CountLine]], frame_size: Tuple[int, int],
+                 min_trace_length: int = 10):
+        names = [zone.name for zone in zones]
+        if len(set(names)) != len(names):
+            raise ValueError(f"The names of the zones must be different, got {names}.")
+        self.index = ZoneIndex(zones, frame_size)
+        self.min_trace_length = min_trace_length
+        self._counts = [0] * len(self.zones)
+        # Length of each active trace, and number of frames it has been in each zone, or None once it is counted
+        self._lengths: Dict[int, int] = {}
+        self._frames_in_zones: List[Dict[int, Optional[int]]] = [{} for _ in self.zones]
+
+    @property
+    def zones(self) -> List[Union[Zone, CountLine]]:
+        return self.index.zones
+
+    @property
+    def counts(self) -> Dict[str, int]:
+        """The number of cars counted in each zone, by zone name."""
+        return {zone.name: count for zone, count in zip(self.zones, self._counts)}
+
+    def update(self, cars: Detections, trace_ids: Sequence[int]) -> None:
+        """Counts the cars of a new frame in the zones they are in.
+
+        Args:
+            cars: the cars tracked in the frame
+            trace_ids: the ids of the traces of the cars, in the same order
+        """
+        cars = Detections.from_rectangles(cars)
+        in_zone = self.index.lookup(cars.centers)
+        # The traces which are not active anymore never come back, so they are forgotten
+        self._lengths = {trace_id: self._lengths.get(trace_id, 0) + 1 for trace_id in trace_ids}
+        for i, zone in enumerate(self.zones):
+            frames_in_zone = {trace_id: self._frames_in_zones[i].get(trace_id, 0) for trace_id in trace_ids}
+            for trace_id, inside in zip(trace_ids, in_zone[:, i].tolist()):
+                if frames_in_zone[trace_id] is None:
+                    continue
+                frames_in_zone[trace_id] += inside
+                if (frames_in_zone[trace_id] >= max(1, zone.min_trace_length)
+                        and self._lengths[trace_id] >= max(1, self.min_trace_length)):
+                    self._counts[i] += 1
+                    frames_in_zone[trace_id] = None
+            self._frames_in_zones[i] = frames_in_zone
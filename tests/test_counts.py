@@ -0,0 +1,20 @@
+"""Regression tests of the number of cars counted in the sample video"""
+import os
+
+from src import Processor
+from src.car_detectors import ClassicDetector
+from src.frame_skipper import FrameSkipper
+
+VIDEO_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "video.avi")
+# Number of cars which pass through the action zone of the sample video
+N_CARS = 20
+
+
+def test_count_with_default_settings():
+    processor = Processor(ClassicDetector(), VIDEO_PATH, stream=True)
+    assert processor.process_video_headless().car_counter == N_CARS
+
+
+def test_count_with_default_frame_skipper():
+    processor = Processor(ClassicDetector(), VIDEO_PATH, stream=True, frame_skipper=FrameSkipper())
+    assert processor.process_video_headless().car_counter == N_CARS